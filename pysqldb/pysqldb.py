@@ -7,13 +7,54 @@ import sys
 import os
 import csv
 import subprocess
+import shutil
+import threading
+import time
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import decimal
+import io
+import uuid
+import hashlib
+import binascii
+import json
+import Queue
+import multiprocessing
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
 
+# shared connection pools keyed on credentials, see get_connection_pool()
+CONNECTION_POOLS = dict()
+CONNECTION_POOLS_LOCK = threading.Lock()
+# connections inherited from the parent process after a fork. They are never closed (or garbage collected) in the
+# child, closing them would also end the parent's session on the server.
+INHERITED_CONNECTIONS = list()
+# DbConnect of a DbConnect.map_query worker process
+WORKER_DBO = None
 
-class DbConnect:
+
+class DbSession:
+    """
+    Connection and last query results of a DbConnect, shared by every thread
+    """
+    conn = None
+    data = None
+
+
+class ThreadDbSession(threading.local):
+    """
+    Connection and last query results of a DbConnect(thread_safe=True), separate for each thread
+    """
+    conn = None
+    data = None
+
+    def __init__(self):
+        # identifies the thread's session in DbConnect.thread_conns (thread idents are reused)
+        self.key = object()
+
+
+class DbConnect(object):
     """
     Database Connection class. Contains db connection, query, inport/export tools
     """
@@ -29,7 +70,38 @@ class DbConnect:
             server (string):
             database (string):
             port (int):
+            pool (bool): If True connections are borrowed from a shared ConnectionPool instead of being
+                opened for every query (defaults to False)
+            pool_min (int): Number of connections kept open in the pool (defaults to 1)
+            pool_max (int): Maximum number of connections the pool will open (defaults to 10)
+            pool_idle_timeout (int): Seconds an idle pooled connection is kept before it is closed (defaults to 300)
+            background_cleanup (bool): If True expired temp tables are dropped in a background thread so the
+                connection is returned immediately (defaults to False)
+            defer_logging (bool): If True new temp tables are only written to the temp log when flush_temp_log()
+                is called, so a batch of queries is logged in one round trip (defaults to False)
+            history_size (int): Number of queries kept in self.queries, None keeps all and 0 keeps none 
+                (defaults to 1000)
+            history_bytes (int): Approximate bytes of result data kept in self.queries, the data of older queries 
+                is dropped beyond this (defaults to 256MB)
+            cache (bool/QueryCache): If True SELECT results are cached (see QueryCache), a QueryCache object can be 
+                passed to share one cache between connections (defaults to False)
+            cache_ttl (int): Seconds a cached result is kept (defaults to 300)
+            cache_bytes (int): Approximate bytes of result data cached (defaults to 64MB)
+            snapshot_dir (str): Folder dfquery(snapshot=True) keeps its result files in 
+                (defaults to ~/.pysqldb/snapshots)
+            snapshot_format (str): File format of snapshots, parquet, feather or pickle (defaults to parquet)
+            thread_safe (bool): If True each thread using this DbConnect gets its own connection and its own 
+                self.data, and shared state (queries, tables_created, temp log) is updated under a lock, so one 
+                DbConnect can be used from a thread pool. The connections of threads that have exited are closed 
+                when another thread connects, call close_sessions() when the threads are done (defaults to False)
+            quiet (bool): If True the connection details are not printed on connect (defaults to False)
+            clean_up (bool): If False expired temp tables are not dropped on connect (defaults to True)
         """
+        self.thread_safe = kwargs.get('thread_safe', False)
+        self.process_id = os.getpid()
+        self.session = ThreadDbSession() if self.thread_safe else DbSession()
+        self.thread_conns = dict()
+        self.lock = threading.RLock()
         self.user = kwargs.get('user', None)
         self.password = kwargs.get('password', None)
         self.LDAP = kwargs.get('ldap', False)
@@ -37,18 +109,145 @@ class DbConnect:
         self.server = kwargs.get('server', None)
         self.database = kwargs.get('database', None)
         self.port = kwargs.get('port', 5432)
+        self.use_pool = kwargs.get('pool', False)
+        self.pool_min = kwargs.get('pool_min', 1)
+        self.pool_max = kwargs.get('pool_max', 10)
+        self.pool_idle_timeout = kwargs.get('pool_idle_timeout', 300)
+        self.pool = None
         self.params = dict()
         self.conn = None
-        self.queries = list()
+        self.queries = QueryHistory(kwargs.get('history_size', 1000), kwargs.get('history_bytes', 256 * 1024 ** 2))
         self.connection_start = None
         self.tables_created = list()
         self.data = None
+        self.log_schemas = set()
+        self.pending_logs = list()
+        self.defer_logging = kwargs.get('defer_logging', False)
+        self.cache = kwargs.get('cache', False)
+        if self.cache is True:
+            self.cache = QueryCache(kwargs.get('cache_ttl', 300), kwargs.get('cache_bytes', 64 * 1024 ** 2))
+        elif not isinstance(self.cache, QueryCache):
+            self.cache = None
+        self.snapshot_dir = kwargs.get('snapshot_dir', os.path.join(os.path.expanduser('~'), '.pysqldb', 'snapshots'))
+        self.snapshot_format = kwargs.get('snapshot_format', 'parquet')
         self.default_schema = self.get_default_schema
-        self.connect()
-        self.clean_logs()
+        self.connect(kwargs.get('quiet', False))
+        if kwargs.get('clean_up', True):
+            self.clean_logs(background=kwargs.get('background_cleanup', False))
 
         # self.pid = self.get_pid()
 
+    @property
+    def conn(self):
+        """
+        Database connection. In thread_safe mode each thread has its own, opened the first time the thread uses it.
+        :return: psycopg2 or pyodbc connection
+        """
+        self.check_process()
+        if self.session.conn is None and self.thread_safe and self.params:
+            self.close_finished_sessions()
+            self.conn = self.borrow_connection()
+        return self.session.conn
+
+    @conn.setter
+    def conn(self, conn):
+        self.session.conn = conn
+        if self.thread_safe:
+            with self.lock:
+                self.thread_conns[self.session.key] = (threading.current_thread(), conn)
+
+    def check_process(self):
+        """
+        Reconnects when the DbConnect is used from a new process (a forked child or an unpickled copy), the 
+        connections inherited from the parent are set aside without being closed
+        :return: None
+        """
+        if self.process_id == os.getpid():
+            return
+        self.process_id = os.getpid()
+        INHERITED_CONNECTIONS.extend([c for c in [self.session.conn] + [i[1] for i in self.thread_conns.values()]
+                                      if c is not None])
+        # the parent's lock may have been held by another thread at the time of the fork
+        self.lock = threading.RLock()
+        self.session = ThreadDbSession() if self.thread_safe else DbSession()
+        self.thread_conns = dict()
+        self.pool = None
+        if self.params:
+            self.connect(True)
+
+    def __getstate__(self):
+        """
+        Pickles the credentials and settings, not the connections, results, history or cache
+        """
+        state = self.__dict__.copy()
+        for i in ('session', 'thread_conns', 'lock', 'pool', 'queries', 'cache', 'default_schema', 'pending_logs'):
+            state.pop(i, None)
+        state['process_id'] = None
+        state['history'] = (self.queries.max_queries, self.queries.max_bytes)
+        state['cache_settings'] = (self.cache.ttl, self.cache.max_bytes) if self.cache is not None else None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restores a pickled DbConnect, it connects the first time its connection is used
+        """
+        history = state.pop('history')
+        cache_settings = state.pop('cache_settings')
+        self.__dict__.update(state)
+        self.session = ThreadDbSession() if self.thread_safe else DbSession()
+        self.thread_conns = dict()
+        self.lock = threading.RLock()
+        self.pool = None
+        self.queries = QueryHistory(*history)
+        self.cache = QueryCache(*cache_settings) if cache_settings else None
+        self.default_schema = self.get_default_schema
+        self.pending_logs = list()
+
+    @property
+    def data(self):
+        """
+        Results of the last query (of the calling thread in thread_safe mode)
+        """
+        return self.session.data
+
+    @data.setter
+    def data(self, data):
+        self.session.data = data
+
+    def close_sessions(self):
+        """
+        Closes (or returns to the pool) the connections of every other thread in thread_safe mode, 
+        only call it once those threads are done with this DbConnect. Does nothing in the default mode, where all 
+        threads share self.conn.
+        :return: None
+        """
+        if not self.thread_safe:
+            return
+        current = self.session.key
+        with self.lock:
+            conns = [(i, conn) for i, (_, conn) in self.thread_conns.items() if i is not current]
+            for i, conn in conns:
+                del self.thread_conns[i]
+        for i, conn in conns:
+            if conn is not None:
+                self.release_connection(conn)
+
+    def close_finished_sessions(self):
+        """
+        Closes (or returns to the pool) the connections of threads that have exited in thread_safe mode. 
+        Runs whenever a thread opens its connection, so short lived threads do not leave connections open.
+        :return: None
+        """
+        if not self.thread_safe:
+            return
+        with self.lock:
+            conns = [(i, conn) for i, (thread, conn) in self.thread_conns.items() if not thread.is_alive()]
+            for i, conn in conns:
+                del self.thread_conns[i]
+        for i, conn in conns:
+            if conn is not None:
+                self.release_connection(conn)
+
     def __str__(self):
         return 'Database connection ({typ}) to {db} on {srv} - user: {usr} \nConnection established {dt}'.format(
             typ=self.type,
@@ -78,7 +277,6 @@ class DbConnect:
                 'host': self.server,
                 'port': self.port
             }
-            self.conn = psycopg2.connect(**self.params)
             # self.pid = self.get_pid()
 
         if self.type.upper() in ('MS', 'SQL', 'MSSQL', 'SQLSERVER'):
@@ -98,20 +296,42 @@ class DbConnect:
                     'PWD': self.password,
                     'SERVER': self.server
                 }
-            # need catch for missing drivers
-            # native client is required for correct handling of datetime2 types in SQL
-            try:
-                self.conn = pyodbc.connect(**self.params)
-            except:
-                # revert to SQL driver and show warning
-                print ('Warning:\n\tMissing SQL Server Native Client 10.0 \
-                datetime2 will not be interpreted correctly\n')
-                self.params['DRIVER'] = 'SQL Server'
-                self.conn = pyodbc.connect(**self.params)
+        if self.use_pool:
+            self.conn = self.get_pool().checkout()
+        else:
+            self.conn = self.open_connection()
         self.connection_start = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         if not quiet:
             print (self)
 
+    def open_connection(self):
+        """
+        Opens a new raw database connection using the parameters set by connect()
+        :return: psycopg2 or pyodbc connection
+        """
+        if self.type == 'PG':
+            return psycopg2.connect(**self.params)
+        # need catch for missing drivers
+        # native client is required for correct handling of datetime2 types in SQL
+        try:
+            return pyodbc.connect(**self.params)
+        except:
+            # revert to SQL driver and show warning
+            print ('Warning:\n\tMissing SQL Server Native Client 10.0 \
+            datetime2 will not be interpreted correctly\n')
+            self.params['DRIVER'] = 'SQL Server'
+            return pyodbc.connect(**self.params)
+
+    def get_pool(self):
+        """
+        Gets the ConnectionPool shared by all pooled DbConnect instances with the same credentials
+        :return: ConnectionPool
+        """
+        self.check_process()
+        if not self.pool:
+            self.pool = get_connection_pool(self)
+        return self.pool
+
     def get_default_schema(self):
         """
         Gets default schema name depending on db type
@@ -136,10 +356,14 @@ class DbConnect:
 
     def disconnect(self, quiet=False):
         """
-        Closes connection to DB
+        Closes connection to DB (pooled connections are returned to the pool)
         :return: None
         """
-        self.conn.close()
+        if self.use_pool:
+            self.get_pool().checkin(self.conn)
+            self.conn = None
+        else:
+            self.conn.close()
         if not quiet:
             print 'Database connection ({typ}) to {db} on {srv} - user: {usr} \nConnection closed {dt}'.format(
                 typ=self.type,
@@ -151,7 +375,8 @@ class DbConnect:
 
     def refresh_connection(self):
         """
-        Disconnects and reconnects from database, to avoid open blocking connections
+        Disconnects and reconnects from database, to avoid open blocking connections.
+        In pooled mode the connection is rolled back and returned to the pool, and a warm one is borrowed.
         :return: None
         """
         self.disconnect(True)
@@ -188,6 +413,9 @@ class DbConnect:
                     permission (bool): description 
                     temp (bool): if True any new tables will be logged for deletion at a future date 
                     remove_date (datetime.date): description
+                    columnar (bool): If true results are stored as a ColumnarResult (typed column arrays) 
+                        instead of a list of rows
+                    cache (bool): If false the query cache is skipped for this query (defaults to True)
             :return: None
         """
         strict = kwargs.get('strict', True)
@@ -196,12 +424,90 @@ class DbConnect:
         timeme = kwargs.get('timeme', True)
         no_comment = kwargs.get('no_comment', False)
         comment = kwargs.get('comment', '')
+        columnar = kwargs.get('columnar', False)
+        cached = self.cached_query(query, columnar) if kwargs.get('cache', True) else None
+        if cached is not None:
+            self.data = cached[0]
+            return
         qry = Query(self, query, strict=strict, permission=permission, temp=temp,
-                    timeme=timeme, no_comment=no_comment, comment=comment)
-        self.queries.append(qry)
+                    timeme=timeme, no_comment=no_comment, comment=comment, columnar=columnar)
+        self.cache_query(query, qry)
+        self.record_query(qry)
         self.refresh_connection()
         self.data = qry.data
-        self.tables_created += [i for i in qry.new_tables]
+
+    def record_query(self, qry):
+        """
+        Adds a Query to the history and keeps tables_created up to date with its new and dropped tables
+        :param qry: Query object
+        :return: None
+        """
+        with self.lock:
+            self.queries.append(qry)
+            self.tables_created += [i for i in qry.new_tables]
+            self.tables_created = [i for i in self.tables_created if i not in qry.dropped_tables]
+
+    def query_many(self, queries, workers=4, **kwargs):
+        """
+        Runs independent queries concurrently, each on its own connection (borrowed from the pool in pooled mode). 
+        At most workers queries run at a time. A failed query is printed and rolled back, it does not exit or 
+        stop the others. New tables are granted, commented and logged as with query().
+        :param queries: list of SQL strings
+        :param workers: Maximum number of queries run at the same time (defaults to 4)
+        :param kwargs: 
+            permission (bool), temp (bool), no_comment (bool), comment (str), columnar (bool): as for query()
+        :return: list of Query objects in the order of queries, with the results in data/data_columns, the timing 
+            in query_time and any error in error (None where no connection could be made)
+        """
+        params = dict(permission=kwargs.get('permission', True), temp=kwargs.get('temp', True),
+                      no_comment=kwargs.get('no_comment', False), comment=kwargs.get('comment', ''),
+                      columnar=kwargs.get('columnar', False))
+
+        # each worker thread borrows one connection and runs all of its queries on it
+        local = threading.local()
+        conns = list()
+
+        def run(query):
+            conn = getattr(local, 'conn', None)
+            if conn is None:
+                try:
+                    conn = self.borrow_connection()
+                except Exception as e:
+                    print ('Failure:\nCould not connect for\n\t{q}\n\t{e}'.format(q=query, e=e))
+                    return None
+                local.conn = conn
+                conns.append(conn)
+            return Query(self, query, conn=conn, strict=False, timeme=False, **params)
+
+        start = time.time()
+        pool = ThreadPool(max(min(workers, len(queries)), 1))
+        try:
+            results = pool.map(run, queries, 1)
+        finally:
+            pool.close()
+            pool.join()
+            for conn in conns:
+                self.release_connection(conn)
+        for query, qry in zip(queries, results):
+            if qry is None:
+                continue
+            self.cache_query(query, qry)
+            self.record_query(qry)
+        failed = len([qry for qry in results if qry is None or qry.error is not None])
+        print '{n} queries run in {t:.1f} seconds ({f} failed)'.format(n=len(queries), t=time.time() - start,
+                                                                      f=failed)
+        return results
+
+    def dfquery_many(self, queries, workers=4, columnar=False):
+        """
+        Runs independent select queries concurrently (see query_many)
+        :param queries: list of SQL select statements
+        :param workers: Maximum number of queries run at the same time (defaults to 4)
+        :param columnar: If true rows are fetched into typed column arrays (see dfquery)
+        :return: list of Pandas DataFrames in the order of queries, None for queries that failed
+        """
+        return [qry.dfquery() if qry is not None and qry.has_data else None
+                for qry in self.query_many(queries, workers, columnar=columnar)]
 
     def drop_table(self, schema, table):
         """
@@ -214,38 +520,357 @@ class DbConnect:
         self.query("""DELETE FROM {s}."{tmp}" WHERE table_schema = '{s}' AND table_name = '{t}'""".format(
             s=schema, t=table, tmp='__temp_log_table_%s__' % self.user), timeme=False)
 
-    def dfquery(self, query, timeme=False):
+    def cached_query(self, query, columnar=False):
+        """
+        Looks up the results of a query in the query cache
+        :param query: SQL statement
+        :param columnar: Whether the result is stored as a ColumnarResult
+        :return: Cached (data, columns) or None
+        """
+        if self.cache is None or not QueryCache.cacheable(classify_sql(query)):
+            return None
+        return self.cache.get(QueryCache.key(self, query, columnar))
+
+    def cache_query(self, query, qry):
+        """
+        Adds the results of a Query to the query cache, if it is a cacheable select
+        :param query: SQL statement as passed to query()/dfquery() (before escaping)
+        :param qry: Query object
+        :return: None
+        """
+        if self.cache is not None and qry.has_data and QueryCache.cacheable(qry.statement_info):
+            self.cache.put(QueryCache.key(self, query, qry.columnar), qry)
+
+    def invalidate_cache(self, tables=None):
+        """
+        Drops cached results that read from the tables, used after loading data outside of query()
+        :param tables: list of [schema.]table names, None drops everything
+        :return: None
+        """
+        if self.cache is not None:
+            self.cache.invalidate(tables)
+
+    def dfquery(self, query, timeme=False, chunksize=None, columnar=False, cache=True, snapshot=False,
+                freshness=None):
         """
         Generates a pandas Dataframe for the results of select SQL query. 
         This will throw an error if no data is returned. 
         :param query: SQL statement 
         :param timeme: default to False, adds timing to query run
+        :param chunksize: If set returns a generator of DataFrames with up to chunksize rows each (see dfquery_chunks)
+        :param columnar: If true rows are fetched into typed column arrays (ColumnarResult) and the DataFrame 
+            is built from those, avoiding a full list of row tuples
+        :param cache: If false the query cache is skipped for this query (defaults to True)
+        :param snapshot: If true the results are saved to disk and reused on later runs while the tables the 
+            query reads from are unchanged (see snapshot_dfquery)
+        :param freshness: Optional SQL returning a modification marker (eg. max(updated_at)) checked instead of 
+            the table change counters when snapshot is true
         :return: Pandas DataFrame
         """
-        qry = Query(self, query, timeme=timeme)
-        self.queries.append(qry)
+        if chunksize:
+            return self.dfquery_chunks(query, chunksize)
+        if snapshot:
+            return self.snapshot_dfquery(query, freshness=freshness, timeme=timeme, columnar=columnar)
+        cached = self.cached_query(query, columnar) if cache else None
+        if cached is not None:
+            self.data, columns = cached
+            if isinstance(self.data, ColumnarResult):
+                return self.data.to_pandas()
+            return pd.DataFrame(self.data, columns=columns)
+        qry = Query(self, query, timeme=timeme, columnar=columnar)
+        self.cache_query(query, qry)
+        self.record_query(qry)
         self.refresh_connection()
         self.data = qry.data
         return qry.dfquery()
 
-    def type_decoder(self, typ):
+    def snapshot_dfquery(self, query, freshness=None, timeme=False, columnar=False):
+        """
+        Runs dfquery and keeps the results in a file under self.snapshot_dir, keyed on a hash of the SQL and the 
+        connection. Later calls (including from other processes) load the file instead of running the query, as 
+        long as the modification markers from snapshot_marker() have not changed since it was written. 
+        self.data is not updated when a snapshot is used.
+        :param query: SQL select statement
+        :param freshness: Optional SQL returning a modification marker, checked instead of the table counters
+        :param timeme: default to False, adds timing to query run
+        :param columnar: If true rows are fetched into typed column arrays (see dfquery)
+        :return: Pandas DataFrame
+        """
+        key = hashlib.sha1(repr(QueryCache.key(self, query))).hexdigest()
+        meta_file = os.path.join(self.snapshot_dir, key + '.json')
+        marker = self.snapshot_marker(query, freshness)
+        if marker is not None and os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if meta.get('marker') == marker:
+                df = read_snapshot(meta['file'], meta['format'])
+                if df is not None:
+                    print 'Using snapshot from {dt} ({f})'.format(dt=meta['created'], f=meta['file'])
+                    return df
+        df = self.dfquery(query, timeme=timeme, columnar=columnar, cache=False)
+        if marker is None:
+            return df
+        fmt, snapshot_file = write_snapshot(df, os.path.join(self.snapshot_dir, key), self.snapshot_format)
+        if snapshot_file:
+            with open(meta_file + '.tmp', 'w') as f:
+                json.dump({'sql': query, 'marker': marker, 'format': fmt, 'file': snapshot_file,
+                           'created': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, f)
+            if os.path.exists(meta_file):
+                os.remove(meta_file)
+            os.rename(meta_file + '.tmp', meta_file)
+        return df
+
+    def snapshot_marker(self, query, freshness=None):
+        """
+        Gets the markers a snapshot is checked against: the rows of the freshness query if given, otherwise the 
+        change counters of the tables the query reads from (pg_stat_user_tables insert/update/delete counts and 
+        file node on PG, sys.tables modify_date and sys.dm_db_index_usage_stats last update on MS). 
+        Table statistics are updated by the server with a short delay and MS usage stats reset on restart, 
+        pass a freshness query where that matters.
+        :param query: SQL select statement
+        :param freshness: Optional SQL returning a modification marker
+        :return: list of rows (as lists of strings), None if the markers could not be read for every table
+        """
+        names = list()
+        if freshness:
+            sql = freshness
+        else:
+            info = classify_sql(query)
+            if not info.complete:
+                print 'Not every table the query reads from is known, the snapshot is not used'
+                return None
+            # quoted names are matched against the catalog without their quotes
+            names = sorted(set([t.split('.')[-1].strip('"[]') for t in info.read_tables]))
+            if not names:
+                return None
+            in_list = ', '.join(["'{}'".format(n.replace("'", "''")) for n in names])
+            if self.type == 'PG':
+                sql = """
+                    SELECT relname, schemaname, relid::bigint, pg_relation_filenode(relid),
+                        n_tup_ins, n_tup_upd, n_tup_del
+                    FROM pg_stat_user_tables
+                    WHERE relname IN ({n})
+                    ORDER BY 1, 2
+                """.format(n=in_list)
+            else:
+                sql = """
+                    SELECT t.name, SCHEMA_NAME(t.schema_id), t.object_id, t.modify_date, 
+                        MAX(u.last_user_update)
+                    FROM sys.tables t
+                    LEFT JOIN sys.dm_db_index_usage_stats u
+                    ON u.object_id = t.object_id AND u.database_id = DB_ID()
+                    WHERE t.name IN ({n})
+                    GROUP BY t.name, t.schema_id, t.object_id, t.modify_date
+                    ORDER BY 1, 2
+                """.format(n=in_list)
+        conn = self.borrow_connection()
+        failed = False
+        try:
+            cur = conn.cursor()
+            cur.execute(sql)
+            rows = cur.fetchall()
+        except Exception as e:
+            failed = True
+            print ('Failure:\nCould not read the snapshot markers, the snapshot is not used\n\t{}'.format(e))
+            return None
+        finally:
+            self.release_connection(conn, discard=failed)
+        # views, temp tables and functions have no counters, results reading from them are not snapshotted
+        missing = set([n.lower() for n in names]) - set([str(row[0]).lower() for row in rows])
+        if missing:
+            print 'No change counters for {t}, the snapshot is not used'.format(t=', '.join(sorted(missing)))
+            return None
+        return [[repr(i) for i in row] for row in rows]
+
+    def borrow_connection(self):
         """
-        Lazy type decoding from pandas to SQL. There are problems assoicated with NaN values for numeric types when 
+        Gets a connection separate from self.conn, from the pool in pooled mode otherwise a new one
+        :return: psycopg2 or pyodbc connection
+        """
+        if self.use_pool:
+            return self.get_pool().checkout()
+        return self.open_connection()
+
+    def release_connection(self, conn, discard=False):
+        """
+        Returns a connection from borrow_connection() to the pool, or closes it
+        :param conn: Connection from borrow_connection()
+        :param discard: If True a pooled connection is closed rather than reused
+        :return: None
+        """
+        if self.use_pool:
+            self.get_pool().checkin(conn, discard)
+        else:
+            try:
+                conn.close()
+            except:
+                pass
+
+    def stream_query(self, query, batch_size=10000):
+        """
+        Runs a select query on its own connection and yields its results in batches. 
+        PG uses a named (server side) cursor and MS uses fetchmany, so only one batch is held in memory.
+        The query is escaped the same way as Query (-pct-, -qte-chr-).
+        :param query: SQL select statement
+        :param batch_size: Number of rows per batch (defaults to 10,000)
+        :return: Generator of (cursor description, list of row tuples)
+        """
+        query = escape_query_string(query)
+        conn = self.borrow_connection()
+        failed = False
+        try:
+            if self.type == 'PG':
+                cur = conn.cursor(name='pysqldb_{}'.format(uuid.uuid4().hex))
+                cur.itersize = batch_size
+            else:
+                cur = conn.cursor()
+            cur.execute(query)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                if self.type == 'MS':
+                    rows = [tuple(i) for i in rows]
+                yield cur.description, rows
+            cur.close()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self.release_connection(conn, discard=failed)
+
+    def iter_query(self, query, batch_size=10000):
+        """
+        Iterates over the results of a select query in batches with constant memory, regardless of result size. 
+        The query runs on its own connection so other queries can be run while iterating. 
+        :param query: SQL select statement
+        :param batch_size: Number of rows per batch (defaults to 10,000)
+        :return: Generator of lists of row tuples
+        """
+        for _, rows in self.stream_query(query, batch_size):
+            yield rows
+
+    def dfquery_chunks(self, query, chunksize=10000):
+        """
+        Generates pandas DataFrames for the results of a select SQL query one batch at a time, from a server side 
+        cursor on its own connection. The dtype of each column is taken from the cursor description so every 
+        chunk has the same schema (integer columns are nullable Int64 and real/double columns float64, so NULLs do 
+        not change the dtype; numeric columns are Decimal objects as in dfquery). 
+        :param query: SQL statement
+        :param chunksize: Number of rows per DataFrame (defaults to 10,000)
+        :return: Generator of Pandas DataFrames
+        """
+        columns, dtypes = None, None
+        for description, rows in self.stream_query(query, chunksize):
+            if dtypes is None:
+                columns = [desc[0] for desc in description]
+                dtypes = description_dtypes(description, self.type)
+            yield rows_to_dataframe(rows, columns, dtypes)
+
+    def map_query(self, func, query, chunksize=10000, processes=None):
+        """
+        Runs the results of a select query through func in a process pool, one chunk at a time. Each worker 
+        process gets its own copy of this DbConnect (connecting on first use), func is called as func(df, dbo) 
+        so it can query the database too. func has to be a module level function so it can be pickled. 
+        At most two chunks per worker are queued so the results are not all held in memory.
+        :param func: function(Pandas DataFrame, DbConnect) run on each chunk
+        :param query: SQL select statement
+        :param chunksize: Number of rows per chunk (defaults to 10,000)
+        :param processes: Number of worker processes (defaults to the number of cpus)
+        :return: list of the return values of func, in chunk order
+        """
+        processes = processes or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(processes, init_map_worker, (self,))
+        pending = deque()
+        results = list()
+        try:
+            for df in self.dfquery_chunks(query, chunksize):
+                pending.append(pool.apply_async(run_map_worker, (func, df)))
+                while len(pending) >= 2 * processes:
+                    results.append(pending.popleft().get())
+            while pending:
+                results.append(pending.popleft().get())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return results
+
+    def type_decoder(self, typ, values=None, exact=True):
+        """
+        Type decoding from pandas to SQL. There are problems assoicated with NaN values for numeric types when 
         stored as Object dtypes. 
 
-        This does not try to optimize for smallest size datatype.
+        Without values this is the lazy mapping (does not try to optimize for smallest size datatype). 
+        With values the column is inspected (vectorized) to pick the smallest type for the backend: 
+        smallint/int/bigint from the value range, real when every value fits a float32 exactly, boolean, date 
+        when there are no times, numeric for decimals, and text (PG) or a varchar sized to the longest value (MS).
 
         :param typ: Numpy dtype for column   
+        :param values: Optional Pandas Series of the column values
+        :param exact: Set to False when values are a sample of the data, integer and varchar sizes get headroom 
         :return: String representing data type 
         """
-        if typ == np.dtype('M'):
-            return 'timestamp'
-        elif typ == np.dtype('int64'):
-            return 'bigint'
-        elif typ == np.dtype('float64'):
-            return 'float'
-        else:
-            return 'varchar (500)'
+        if values is None or values.dropna().empty:
+            if typ == np.dtype('M'):
+                return 'timestamp'
+            elif typ == np.dtype('int64'):
+                return 'bigint'
+            elif typ == np.dtype('float64'):
+                return 'float'
+            else:
+                return 'varchar (500)'
+        pg = self.type == 'PG'
+        values = values.dropna()
+
+        def int_type(lo, hi):
+            sizes = [(32767, 'smallint'), (2147483647, 'integer' if pg else 'int'), (9223372036854775807, 'bigint')]
+            for i, (limit, name) in enumerate(sizes):
+                if -limit - 1 <= lo and hi <= limit:
+                    return sizes[i if exact else min(i + 1, len(sizes) - 1)][1]
+            return 'numeric' if pg else 'numeric (38, 0)'
+
+        def string_type(length):
+            if pg:
+                return 'text'
+            n = 2 ** int(np.ceil(np.log2(max(length, 1))))
+            n = max(n, 16) if exact else max(n * 2, 255)
+            return 'varchar ({})'.format(n) if n <= 8000 else 'varchar (max)'
+
+        if typ == np.dtype('bool'):
+            return 'boolean' if pg else 'bit'
+        elif typ.kind in 'iu':
+            return int_type(int(values.min()), int(values.max()))
+        elif typ.kind == 'f':
+            floats = values.values.astype(np.float64)
+            if exact and np.array_equal(floats.astype(np.float32).astype(np.float64), floats):
+                return 'real'
+            return 'double precision' if pg else 'float'
+        elif typ.kind == 'M':
+            if exact and (values.dt.normalize() == values).all():
+                return 'date'
+            return 'timestamp' if pg else 'datetime2'
+        kind = pd.api.types.infer_dtype(values.values)
+        if kind == 'boolean':
+            return 'boolean' if pg else 'bit'
+        elif kind == 'integer':
+            return int_type(int(values.min()), int(values.max()))
+        elif kind in ('floating', 'mixed-integer-float'):
+            return 'double precision' if pg else 'float'
+        elif kind == 'decimal':
+            if pg:
+                return 'numeric'
+            scale = values.astype(str).str.split('.').str[1].str.len().max()
+            return 'numeric (38, {})'.format(min(int(scale), 18) if scale == scale else 0)
+        elif kind == 'date':
+            return 'date'
+        elif kind in ('datetime', 'datetime64'):
+            return 'timestamp' if pg else 'datetime2'
+        elif kind in ('string', 'unicode', 'bytes'):
+            return string_type(int(values.str.len().max()))
+        return 'text' if pg else 'varchar (500)'
 
     def clean_cell(self, x):
         """
@@ -284,6 +909,50 @@ class DbConnect:
         else:
             return x
 
+    def clean_dataframe(self, df):
+        """
+        Formats a whole DataFrame for SQL to add to database. Applies the same rules as clean_cell, but column by 
+        column with vectorized pandas operations: datetime columns are formatted in one pass, and object columns 
+        are split by cell type so strings, decimals and dates are each converted together. 
+        :param df: Pandas DataFrame 
+        :return: Pandas DataFrame of object columns with formatted python values (None for empty cells)
+        """
+        data = dict()
+        for i in range(df.shape[1]):
+            s = df.iloc[:, i]
+            nulls = pd.isnull(s.values)
+            if s.dtype.kind == 'M':
+                cleaned = s.dt.strftime('%Y-%m-%d %H:%M').values.astype(object)
+            elif s.dtype == np.dtype('O'):
+                cleaned = s.values.copy()
+                types = s.map(type)
+                strs = (types == str).values
+                if strs.any():
+                    cleaned[strs] = s[strs].str.replace("'", ' ', regex=False).values
+                # unicode is normalized then encoded so it is not written to the sql as u'...'
+                texts = (types == unicode).values
+                if texts.any():
+                    cleaned[texts] = s[texts].str.replace("'", ' ', regex=False) \
+                        .str.replace(u'\xa0', ' ', regex=False) \
+                        .str.replace(u"\u2019", '-qte-chr-', regex=False) \
+                        .str.encode('utf-8').values
+                nums = types.isin([long, decimal.Decimal]).values
+                if nums.any():
+                    cleaned[nums] = s[nums].astype(float).values
+                dates = (types == datetime.date).values
+                if dates.any():
+                    cleaned[dates] = pd.to_datetime(s[dates]).dt.strftime('%Y-%m-%d').values
+                stamps = types.isin([datetime.datetime, pd.Timestamp]).values
+                if stamps.any():
+                    cleaned[stamps] = pd.to_datetime(s[stamps]).dt.strftime('%Y-%m-%d %H:%M').values
+            else:
+                cleaned = s.values.astype(object)
+            cleaned[nulls] = None
+            data[i] = cleaned
+        out = pd.DataFrame(data, index=df.index, columns=range(df.shape[1]), dtype=object)
+        out.columns = df.columns
+        return out
+
     def clean_column(self, x):
         """
         Reformats column names to for database
@@ -308,16 +977,18 @@ class DbConnect:
             :schema (str): Database schema to use for destination in database (defaults to public (PG)/ dbo (MS))
             :overwrite (bool): If table exists in database will overwrite if True (defaults to False)
             :temp (bool): Optional flag to make table as not-temporary (defaults to False)
+            :exact (bool): Set to False when df is a sample of the data, column sizes get headroom (defaults to True)
         :return: Table schema that was created from DataFrame
         """
         overwrite = kwargs.get('overwrite', False)
         schema = kwargs.get('schema', self.default_schema )
         temp = kwargs.get('temp', True)
+        exact = kwargs.get('exact', True)
         input_schema = list()
 
         # parse df for schema
         for col in df.dtypes.iteritems():
-            col_name, col_type = col[0], self.type_decoder(col[1])
+            col_name, col_type = col[0], self.type_decoder(col[1], df[col[0]], exact)
             input_schema.append([self.clean_column(col_name), col_type])
         if self.type == 'PG':
             it = ' IF EXISTS '
@@ -348,39 +1019,161 @@ class DbConnect:
             :schema (str): Database schema to use for destination in database (defaults to public (PG)/ dbo (MS))
             :overwrite (bool): If table exists in database will overwrite if True (defaults to False)
             :temp (bool): Optional flag to make table as not-temporary (defaults to False)
+            :bulk (bool): Use the bulk loader for the database type instead of row by row inserts (defaults to True)
+            :chunk_size (int): Number of rows sent per COPY chunk by the PG bulk loader (defaults to 100,000)
+            :batch_size (int): Number of rows sent per executemany batch by the MS bulk loader (defaults to 10,000)
         :return: None
         """
         overwrite = kwargs.get('overwrite', False)
         temp = kwargs.get('temp', True)
         table_schema = kwargs.get('table_schema', None)
         schema = kwargs.get('schema',self.default_schema)
+        bulk = kwargs.get('bulk', True)
+        chunk_size = kwargs.get('chunk_size', 100000)
+        batch_size = kwargs.get('batch_size', 10000)
 
         if not table_schema:
             table_schema = self.dataframe_to_table_schema(df, table_name, overwrite=overwrite, schema=schema, temp=temp)
         # insert data
         print 'Reading data into Database\n'
-        for _, row in tqdm(df.iterrows()):
-            row = row.replace({pd.np.nan: None})  # clean up empty cells
-            self.query("""
-                INSERT INTO {s}.{t} ({cols})
-                VALUES ({d})
-            """.format(s=schema, t=table_name,
-                       cols=str(['"' + str(i[0]) + '"' for i in table_schema])[1:-1].replace("'", ''),
-                       d=str([self.clean_cell(i) for i in row.values])[1:-1].replace(
-                           'None', 'NULL')), strict=False, timeme=False)
+        self.insert_dataframe(df, table_name, table_schema=table_schema, schema=schema, bulk=bulk,
+                              chunk_size=chunk_size, batch_size=batch_size)
 
         df = self.dfquery("SELECT COUNT(*) as cnt FROM {s}.{t}".format(s=schema, t=table_name), timeme=False)
         print '\n{c} rows added to {s}.{t}\n'.format(c=df.cnt.values[0], s=schema, t=table_name)
 
+    def insert_dataframe(self, df, table_name, **kwargs):
+        """
+        Inserts the rows of a Pandas DataFrame into an existing table with the bulk loader for the database type, 
+        falling back to row by row inserts for anything the bulk loader did not commit.
+        :param df: Pandas DataFrame to be added to database
+        :param table_name: Table name in database
+        :param kwargs: 
+            :table_schema: schema of dataframe (returned from dataframe_to_table_schema)
+            :schema (str): Database schema of the table (defaults to public (PG)/ dbo (MS))
+            :bulk (bool): Use the bulk loader for the database type (defaults to True)
+            :chunk_size (int): Number of rows sent per COPY chunk by the PG bulk loader (defaults to 100,000)
+            :batch_size (int): Number of rows sent per executemany batch by the MS bulk loader (defaults to 10,000)
+        :return: None
+        """
+        table_schema = kwargs.get('table_schema', None)
+        schema = kwargs.get('schema', self.default_schema)
+        bulk = kwargs.get('bulk', True)
+        chunk_size = kwargs.get('chunk_size', 100000)
+        batch_size = kwargs.get('batch_size', 10000)
+        if not table_schema:
+            table_schema = [[self.clean_column(i), None] for i in df.columns]
+        loaded = 0
+        if bulk and self.type == 'PG':
+            loaded = self.copy_dataframe_to_table(df, table_name, table_schema=table_schema, schema=schema,
+                                                  chunk_size=chunk_size)
+        elif bulk and self.type == 'MS':
+            loaded = self.executemany_dataframe_to_table(df, table_name, table_schema=table_schema, schema=schema,
+                                                         batch_size=batch_size)
+        if loaded:
+            self.invalidate_cache([table_name])
+        if loaded < df.shape[0]:
+            # anything the bulk loader did not commit is inserted row by row
+            for row in tqdm(self.clean_dataframe(df.iloc[loaded:]).values.tolist()):
+                self.query("""
+                    INSERT INTO {s}.{t} ({cols})
+                    VALUES ({d})
+                """.format(s=schema, t=table_name,
+                           cols=str(['"' + str(i[0]) + '"' for i in table_schema])[1:-1].replace("'", ''),
+                           d=', '.join([sql_literal(i) for i in row])), strict=False, timeme=False)
+
+    def copy_dataframe_to_table(self, df, table_name, **kwargs):
+        """
+        Streams a Pandas DataFrame into an existing table using COPY FROM STDIN (PG only). 
+        The DataFrame is sent in COPY text format (see dataframe_to_copy_text) in chunks so only one chunk is held 
+        as text at a time.
+        :param df: Pandas DataFrame to be added to database
+        :param table_name: Table name in database
+        :param kwargs: 
+            :table_schema: schema of dataframe (returned from dataframe_to_table_schema)
+            :schema (str): Database schema of the table (defaults to public)
+            :chunk_size (int): Number of rows sent per COPY chunk (defaults to 100,000)
+        :return: Number of rows loaded (0 if the COPY failed and was rolled back)
+        """
+        table_schema = kwargs.get('table_schema', None)
+        schema = kwargs.get('schema', self.default_schema)
+        chunk_size = kwargs.get('chunk_size', 100000)
+        if self.type != 'PG':
+            return 0
+        if not table_schema:
+            table_schema = [[self.clean_column(i), None] for i in df.columns]
+        copy_sql = """COPY {s}.{t} ({cols}) FROM STDIN WITH (FORMAT text)""".format(
+            s=schema, t=table_name, cols=', '.join(['"' + str(i[0]) + '"' for i in table_schema]))
+        cur = self.conn.cursor()
+        try:
+            for start in tqdm(range(0, df.shape[0], chunk_size)):
+                data = dataframe_to_copy_text(df.iloc[start:start + chunk_size])
+                cur.copy_expert(copy_sql, io.BytesIO(data))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            print ('Failure:\nCOPY into {s}.{t} failed, reverting to inserts\n\t{e}'.format(
+                s=schema, t=table_name, e=e))
+            return 0
+        return df.shape[0]
+
+    def executemany_dataframe_to_table(self, df, table_name, **kwargs):
+        """
+        Inserts a Pandas DataFrame into an existing table with parameterized executemany batches (MS only).
+        Uses pyodbc fast_executemany where available so each batch is sent as a single parameter array.
+        Each batch is committed on its own.
+        :param df: Pandas DataFrame to be added to database
+        :param table_name: Table name in database
+        :param kwargs: 
+            :table_schema: schema of dataframe (returned from dataframe_to_table_schema)
+            :schema (str): Database schema of the table (defaults to dbo)
+            :batch_size (int): Number of rows per executemany batch (defaults to 10,000)
+        :return: Number of rows committed before any failure
+        """
+        table_schema = kwargs.get('table_schema', None)
+        schema = kwargs.get('schema', self.default_schema)
+        batch_size = kwargs.get('batch_size', 10000)
+        if self.type != 'MS':
+            return 0
+        if not table_schema:
+            table_schema = [[self.clean_column(i), None] for i in df.columns]
+        insert = 'INSERT INTO {s}.{t} ({cols}) VALUES ({p})'.format(
+            s=schema, t=table_name, cols=', '.join(['"' + str(i[0]) + '"' for i in table_schema]),
+            p=', '.join(['?'] * len(table_schema)))
+        cur = self.conn.cursor()
+        try:
+            cur.fast_executemany = True
+        except AttributeError:
+            # older pyodbc, executemany still avoids building sql per row
+            pass
+        loaded = 0
+        try:
+            for start in tqdm(range(0, df.shape[0], batch_size)):
+                chunk = df.iloc[start:start + batch_size]
+                # object dtype turns numpy scalars into python types pyodbc can bind, NaN/NaT to None
+                rows = chunk.astype(object).where(pd.notnull(chunk), None).values.tolist()
+                cur.executemany(insert, rows)
+                self.conn.commit()
+                loaded += len(rows)
+        except Exception as e:
+            self.conn.rollback()
+            print ('Failure:\nBatch insert into {s}.{t} failed after {r} rows, reverting to inserts\n\t{e}'.format(
+                s=schema, t=table_name, r=loaded, e=e))
+        return loaded
+
     def csv_to_table(self, **kwargs):
         """
         Imports csv file to database. This uses pandas datatypes to generate the table schema. 
+        The schema is inferred from a sample of the file (see csv_sample) and the file is loaded in chunks, 
+        so the whole file is never held in memory. 
         :param kwargs: 
             input_file (str): File path to csv file
             overwrite (bool): If table exists in database will overwrite 
             schema (str): Define schema, defaults to public (PG)/ dbo (MS)
             table_name: (str): name for database table
             sep (str): Separator for csv file, defaults to comma (,)
+            sample_size (int): Number of rows sampled from across the file to infer the schema (defaults to 10,000)
+            chunk_size (int): Number of rows read from the file at a time (defaults to 100,000)
         :return: 
         """
         input_file = kwargs.get('input_file', None)
@@ -390,27 +1183,47 @@ class DbConnect:
             u=self.user, d=datetime.datetime.now().strftime('%Y%m%d%H%M')))
         temp = kwargs.get('temp', True)
         sep = kwargs.get('sep', ',')
+        sample_size = kwargs.get('sample_size', 10000)
+        chunk_size = kwargs.get('chunk_size', 100000)
         if not input_file:
             input_file = file_loc('file')
-        # use pandas to get existing data and schema
-
-        df = pd.read_csv(input_file, sep=sep)
+        # use pandas on a sample of the file to get the schema
+        df, rows = csv_sample(input_file, sep=sep, sample_size=sample_size, chunk_size=chunk_size)
         if 'ogc_fid' in df.columns:
             df = df.drop('ogc_fid', 1)
         if not table_name:
             table_name = os.path.basename(input_file).split('.')[0]
-        input_schema = self.dataframe_to_table_schema(df, table_name, overwrite=overwrite, schema=schema, temp=temp)
-        # for larger files use GDAL to import
-        if df.shape[0] > 999:
+        input_schema = self.dataframe_to_table_schema(df, table_name, overwrite=overwrite, schema=schema, temp=temp,
+                                                      exact=rows <= df.shape[0])
+        # for larger files COPY the file straight in (MS batches through executemany in insert_dataframe)
+        if rows > 999 and self.type == 'PG':
             # try to bulk load on failure should revert to insert method
-            if not self.bulk_csv_to_table(input_schema=input_schema, **kwargs):
-                self.dataframe_to_table(df, table_name, table_schema=input_schema, overwrite=overwrite, schema=schema,
-                                        temp=temp)
-        else:
-            self.dataframe_to_table(df, table_name, table_schema=input_schema, overwrite=overwrite, schema=schema,
-                                    temp=temp)
+            if self.bulk_csv_to_table(input_schema=input_schema, **dict(kwargs, table_name=table_name, schema=schema)):
+                return
+        print 'Reading data into Database\n'
+        # values are passed on as the text in the file and cast by the database
+        for chunk in pd.read_csv(input_file, sep=sep, dtype=str, chunksize=chunk_size):
+            if 'ogc_fid' in chunk.columns:
+                chunk = chunk.drop('ogc_fid', 1)
+            self.insert_dataframe(chunk, table_name, table_schema=input_schema, schema=schema, chunk_size=chunk_size)
+        df = self.dfquery("SELECT COUNT(*) as cnt FROM {s}.{t}".format(s=schema, t=table_name), timeme=False)
+        print '\n{c} rows added to {s}.{t}\n'.format(c=df.cnt.values[0], s=schema, t=table_name)
 
     def bulk_csv_to_table(self, **kwargs):
+        """
+        Bulk loads a csv file into an existing table (created from input_schema). 
+        PG streams the file through COPY FROM STDIN straight into the typed table, with empty values loaded as NULL. 
+        If the COPY fails on a cast the file is copied into an all text staging table and moved to the final table 
+        with explicit casts. MS loads the file in chunks through insert_dataframe. 
+        :param kwargs: 
+            input_file (str): File path to csv file
+            schema (str): Define schema, defaults to public (PG)/ dbo (MS)
+            table_name: (str): name of the database table
+            sep (str): Separator for csv file, defaults to comma (,)
+            input_schema: schema of the table (returned from dataframe_to_table_schema)
+            chunk_size (int): Number of rows read from the file at a time for MS (defaults to 100,000)
+        :return: True if the file was loaded
+        """
         print 'Bulk loading data...'
         input_file = kwargs.get('input_file', None)
         schema = kwargs.get('schema', self.default_schema)
@@ -419,77 +1232,100 @@ class DbConnect:
             u=self.user, d=datetime.datetime.now().strftime('%Y%m%d%H%M')))
         sep = kwargs.get('sep', ',')
         input_schema = kwargs.get('input_schema', None)
-        types = {'PG': 'PostgreSQL', 'MS': 'MSSQLSpatial'}
-        # Build staging table using GDAL to import data
-        # This is needed because GDAL doesnt parse datatypes (all to varchar)
-        if self.type == 'PG':
-            cmd = """ogr2ogr -f "{t}" 
-            PG:"host={server} 
-            user={user} 
-            dbname={db} 
-            password={password}
-            port={port}"
-            {f} 
-            -oo EMPTY_STRING_AS_NULL=YES
-            -nln "{schema}.stg_{tbl}" 
-            """.format(t=types[self.type],
-                       server=self.server,
-                       port=self.port,
-                       user=self.user,
-                       password=self.password,
-                       db=self.database,
-                       f=input_file,
-                       schema=schema,
-                       tbl=table_name
-                       )
-        else:
-            cmd = """ogr2ogr -f "{t}" "MSSQL:server={server}; 
-                     UID={user}; database={db}; PWD={password}"
-                     -nln "{schema}.stg_{tbl}" 
-                     {f} 
-                     -oo EMPTY_STRING_AS_NULL=YES
-                     --config MSSQLSPATIAL_USE_GEOMETRY_COLUMNS NO
-                     """.format(t=types[self.type],
-                                server=self.server,
-                                user=self.user,
-                                password=self.password,
-                                db=self.database,
-                                f=input_file,
-                                schema=schema,
-                                tbl=table_name
-                                )
-        # print cmd.replace('\n', ' ')
-        subprocess.call(cmd.replace('\n', ' '), shell=True)
-        # move data to final table
-        self.query("ALTER TABLE {s}.stg_{t} DROP COLUMN IF EXISTS ogc_fid".format(
-            s=schema, t=table_name), strict=False, timeme=False)
-        # need to get staging field names, GDAL sanitizes differently
-        if self.type == 'SQL':
-            sq, p = 'TOP 1', ''
+        chunk_size = kwargs.get('chunk_size', 100000)
+        if not input_schema:
+            return False
+        if self.type != 'PG':
+            for chunk in pd.read_csv(input_file, sep=sep, dtype=str, chunksize=chunk_size):
+                if 'ogc_fid' in chunk.columns:
+                    chunk = chunk.drop('ogc_fid', 1)
+                self.insert_dataframe(chunk, table_name, table_schema=input_schema, schema=schema)
         else:
-            sq, p = '', 'LIMIT 1'
-        qry = Query(self, "select {sq} * from {s}.stg_{t} {p}".format(
-            s=schema, t=table_name, sq=sq, p=p),
-                    strict=False, timeme=False)
-        qry = '''INSERT INTO {s}.{t}
-                SELECT
-                {cols}
-                FROM {s}.stg_{t}
-            '''.format(
-            s=schema,
-            t=table_name,
-            # cast all fields to new type to move from stg to final table
-            # take staging field name from stg table
-            cols=str(['CAST("' + qry.data_columns[i[0]] + '" as ' + i[1][1] + ')' for i in enumerate(input_schema)
-                      if i[1][0] != 'ogc_fid']).replace(
-                "'", "")[1:-1]
-        )
-        self.query(qry, timeme=False)
-        self.query("DROP TABLE {s}.stg_{t}".format(s=schema, t=table_name), timeme=False)
+            with open(input_file, 'rb') as inf:
+                file_columns = [self.clean_column(i) for i in next(csv.reader(inf, delimiter=sep))]
+            # COPY can not skip columns, files with extra columns (ogc_fid) go through staging
+            if file_columns == [i[0] for i in input_schema]:
+                loaded = self.copy_csv(input_file, schema, table_name, file_columns, sep)
+            else:
+                loaded = None
+            if loaded is None:
+                loaded = self.copy_csv_staged(input_file, schema, table_name, file_columns, sep, input_schema)
+            if not loaded:
+                return False
+            self.invalidate_cache([table_name])
         df = self.dfquery("SELECT COUNT(*) as cnt FROM {s}.{t}".format(s=schema, t=table_name), timeme=False)
         print '\n{c} rows added to {s}.{t}\n'.format(c=df.cnt.values[0], s=schema, t=table_name)
         return True
 
+    def copy_csv(self, input_file, schema, table_name, columns, sep=','):
+        """
+        Streams a csv file into a table with COPY FROM STDIN (PG only). Empty values, quoted or not, are NULL.
+        :param input_file: File path to csv file (with a header row)
+        :param schema: Schema of the table
+        :param table_name: Table name
+        :param columns: Column names in the order they appear in the file
+        :param sep: Separator for csv file, defaults to comma (,)
+        :return: True if loaded, None if a value could not be cast to its column type, False on any other failure
+        """
+        cols = ', '.join(['"' + i + '"' for i in columns])
+        copy_sql = """COPY {s}.{t} ({c}) FROM STDIN WITH (FORMAT csv, HEADER true, DELIMITER '{d}', 
+                      FORCE_NULL ({c}))""".format(s=schema, t=table_name, c=cols, d=sep)
+        cur = self.conn.cursor()
+        try:
+            with open(input_file, 'rb') as inf:
+                cur.copy_expert(copy_sql, inf)
+            self.conn.commit()
+            return True
+        except psycopg2.DataError as e:
+            self.conn.rollback()
+            print ('COPY into {s}.{t} failed on a cast, loading through a staging table\n\t{e}'.format(
+                s=schema, t=table_name, e=e))
+            return None
+        except Exception as e:
+            self.conn.rollback()
+            print ('Failure:\nCOPY into {s}.{t} failed\n\t{e}'.format(s=schema, t=table_name, e=e))
+            return False
+
+    def copy_csv_staged(self, input_file, schema, table_name, file_columns, sep, input_schema):
+        """
+        Loads a csv file through an all text stg_ table: the file is copied into staging, then inserted into the 
+        final table casting each column to its type. Integer columns accept a trailing .0 (as pandas writes integers 
+        with nulls) and are cast straight to their type, so fractional values like 1.5 are rejected, not rounded. 
+        :param input_file: File path to csv file (with a header row)
+        :param schema: Schema of the table
+        :param table_name: Table name
+        :param file_columns: Column names in the order they appear in the file
+        :param sep: Separator for csv file
+        :param input_schema: schema of the table (returned from dataframe_to_table_schema)
+        :return: True if loaded
+        """
+        stg = 'stg_{}'.format(table_name)
+        cur = self.conn.cursor()
+        cur.execute('DROP TABLE IF EXISTS {s}.{t}; CREATE TABLE {s}.{t} ({c})'.format(
+            s=schema, t=stg, c=', '.join(['"' + i + '" text' for i in file_columns])))
+        self.conn.commit()
+        loaded = self.copy_csv(input_file, schema, stg, file_columns, sep)
+        if loaded:
+            casts = list()
+            for col, typ in input_schema:
+                value = "NULLIF(trim(\"{c}\"), '')".format(c=col)
+                if typ in ('bigint', 'integer', 'int', 'smallint'):
+                    value = "regexp_replace({v}, '\\.0*$', '')".format(v=value)
+                casts.append('CAST({v} as {t})'.format(v=value, t=typ))
+            try:
+                cur.execute('INSERT INTO {s}.{t} ({c}) SELECT {v} FROM {s}.{stg}'.format(
+                    s=schema, t=table_name, stg=stg, c=', '.join(['"' + i[0] + '"' for i in input_schema]),
+                    v=', '.join(casts)))
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                print ('Failure:\nMoving {s}.{stg} into {s}.{t} failed\n\t{e}'.format(
+                    s=schema, stg=stg, t=table_name, e=e))
+                loaded = False
+        cur.execute('DROP TABLE IF EXISTS {s}.{t}'.format(s=schema, t=stg))
+        self.conn.commit()
+        return bool(loaded)
+
     def xls_to_table(self, **kwargs):
         """
         Imports csv file to database. This uses pandas datatypes to generate the table schema. 
@@ -519,8 +1355,9 @@ class DbConnect:
 
     def query_to_csv(self, query, **kwargs):
         """
-        Exports query results to a csv file. 
-        :param query: SQL query as string type 
+        Exports query results to a csv file. Results are streamed to the file (COPY TO STDOUT on PG,
+        fetchmany batches on MS) so memory use stays flat regardless of result size.
+        :param query: SQL query as string type
         :param kwargs: 
             sep: Delimiter
             strict (bool): If true will run sys.exit on failed query attempts 
@@ -536,9 +1373,71 @@ class DbConnect:
         open_file = kwargs.get('open_file', False)
         sep = kwargs.get('sep', ',')
         quote_strings = kwargs.get('quote_strings', False)
-        qry = Query(self, query, strict=strict)
         print 'Writing to %s' % output
-        qry.query_to_csv(output=output, open_file=open_file, quote_strings=quote_strings, sep=sep)
+        rows = self.stream_query_to_csv(query, output, sep=sep, quote_strings=quote_strings, strict=strict)
+        if open_file and rows is not None:
+            os.startfile(output)
+
+    def stream_query_to_csv(self, query, output, **kwargs):
+        """
+        Streams query results into a csv file on a separate connection.
+        PG runs COPY (query) TO STDOUT straight into the file, MS writes fetchmany batches with the csv module.
+        Strings are quoted with single quotes, matching Query.query_to_csv.
+        :param query: SQL select statement
+        :param output: File path for csv file
+        :param kwargs:
+            sep: Delimiter (defaults to ',')
+            quote_strings (bool): If true non-numeric values are quoted
+            header (bool): Write the column names as the first row (defaults to True)
+            strict (bool): If true will run sys.exit on failed query attempts
+            batch_size (int): Rows per fetch for MS (defaults to 10,000)
+        :return: Number of rows written (None if the query failed)
+        """
+        sep = kwargs.get('sep', ',')
+        quote_strings = kwargs.get('quote_strings', False)
+        header = kwargs.get('header', True)
+        strict = kwargs.get('strict', True)
+        batch_size = kwargs.get('batch_size', 10000)
+        rows = 0
+        try:
+            with open(output, 'wb') as ouf:
+                if self.type == 'PG':
+                    query = escape_query_string(query.strip().rstrip(';'))
+                    options = ['FORMAT csv', "DELIMITER '{d}'".format(d=sep), "QUOTE ''''"]
+                    if header:
+                        options.append('HEADER')
+                    conn = self.borrow_connection()
+                    try:
+                        cur = conn.cursor()
+                        if quote_strings:
+                            # like QUOTE_NONNUMERIC on MS, only the non-numeric columns are quoted
+                            cur.execute('SELECT * FROM ({q}) q LIMIT 0'.format(q=query))
+                            quoted = ['"{}"'.format(desc[0].replace('"', '""')) for desc in cur.description
+                                      if desc[1] not in PG_INT_TYPES + PG_FLOAT_TYPES + (1700,)]
+                            conn.rollback()
+                            if quoted:
+                                options.append('FORCE_QUOTE ({c})'.format(c=', '.join(quoted)))
+                        cur.copy_expert('COPY ({q}) TO STDOUT ({o})'.format(q=query, o=', '.join(options)), ouf)
+                        rows = cur.rowcount
+                    finally:
+                        self.release_connection(conn)
+                else:
+                    writer = csv.writer(ouf, delimiter=sep, quotechar="'",
+                                        quoting=csv.QUOTE_NONNUMERIC if quote_strings else csv.QUOTE_MINIMAL)
+                    # stream_query applies the pysqldb escapes
+                    for description, batch in self.stream_query(query, batch_size):
+                        if rows == 0 and header:
+                            writer.writerow([desc[0] for desc in description])
+                        writer.writerows([[i.encode('utf-8') if isinstance(i, unicode) else i for i in row]
+                                          for row in batch])
+                        rows += len(batch)
+        except Exception as e:
+            print ('Failure:\n')
+            print ('- Query run {dt}\n\t{q}\n\t{e}'.format(dt=datetime.datetime.now(), q=query, e=e))
+            if strict:
+                sys.exit()
+            return None
+        return rows
 
     def query_to_shp(self, query, **kwargs):
         """
@@ -565,9 +1464,124 @@ class DbConnect:
                          gdal_data_loc=gdal_data_loc)
 
     def table_to_csv(self, table_name, **kwargs):
+        """
+        Exports a table (or query) to csv using several workers in parallel. The rows are split into ranges of a
+        key column, or into ctid page ranges of the table on PG 14+ when no key is given (older PG servers fall back to
+        an integer primary key). Each range is streamed by its own thread and connection into a shard file
+        (see stream_query_to_csv).
+        :param table_name: Table name to export (ignored if query is given)
+        :param kwargs:
+            schema (str): Schema of the table (defaults to public (PG)/ dbo (MS))
+            query (str): Select query to export instead of a table (requires key)
+            key (str): Numeric column used to split the rows into ranges
+            workers (int): Number of shards exported at once (defaults to 4)
+            output: File path for csv file, shards are written as <output>_<n>.csv
+            merge (bool): If true shards are combined into the output file when done (defaults to False)
+            sep: Delimiter (defaults to ',')
+            quote_strings (bool): If true will use quote strings
+        :return: Pandas DataFrame with the file, rows and seconds for each shard
+        """
+        schema = kwargs.get('schema', self.get_default_schema())
+        query = kwargs.get('query', None)
+        key = kwargs.get('key', None)
+        workers = kwargs.get('workers', 4)
+        output = kwargs.get('output',
+                            os.path.join(os.getcwd(), '{t}_{d}.csv'.format(
+                                t=table_name, d=datetime.datetime.now().strftime('%Y%m%d%H%M'))))
+        merge = kwargs.get('merge', False)
+        sep = kwargs.get('sep', ',')
+        quote_strings = kwargs.get('quote_strings', False)
 
-        # TODO: Build this
-        pass
+        if query:
+            source = '({q}) src'.format(q=query.strip().rstrip(';'))
+        else:
+            source = '{s}.{t}'.format(s=schema, t=table_name)
+
+        # before PG 14 ctid ranges are not TID range scans, so every shard would read the whole table.
+        # Use a single column integer primary key instead when there is one.
+        if not key and not query and self.type == 'PG' and self.conn.server_version < 140000:
+            self.query("""
+                SELECT a.attname
+                FROM pg_index i
+                JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                WHERE i.indrelid = '{src}'::regclass AND i.indisprimary AND i.indnatts = 1
+                AND a.atttypid IN ('int2'::regtype, 'int4'::regtype, 'int8'::regtype)
+            """.format(src=source), timeme=False)
+            if self.data:
+                key = self.data[0][0]
+
+        # build the where clause for each shard
+        shards = list()
+        if key:
+            self.query('SELECT MIN({k}), MAX({k}) FROM {src}'.format(k=key, src=source), timeme=False)
+            lo, hi = self.data[0]
+            if isinstance(lo, (int, long, float, decimal.Decimal)) and lo != hi and workers > 1:
+                step = (float(hi) - float(lo)) / workers
+                bounds = [float(lo) + step * i for i in range(1, workers)]
+                if isinstance(lo, (int, long)):
+                    bounds = sorted(set([int(i) for i in bounds]))
+                # the first and last shards are open ended so rounding of the bounds cannot drop rows
+                shards.append('{k} < {b}'.format(k=key, b=bounds[0]))
+                for a, b in zip(bounds[:-1], bounds[1:]):
+                    shards.append('{k} >= {a} AND {k} < {b}'.format(k=key, a=a, b=b))
+                shards.append('{k} >= {a} OR {k} IS NULL'.format(k=key, a=bounds[-1]))
+        elif self.type == 'PG' and not query and self.conn.server_version >= 140000:
+            self.query("SELECT pg_relation_size('{src}') / current_setting('block_size')::int".format(src=source),
+                       timeme=False)
+            pages = int(self.data[0][0])
+            step = max(pages // workers, 1)
+            bounds = range(0, pages, step)[:workers]
+            for i, a in enumerate(bounds):
+                if i < len(bounds) - 1:
+                    shards.append("ctid >= '({a},0)'::tid AND ctid < '({b},0)'::tid".format(a=a, b=bounds[i + 1]))
+                else:
+                    shards.append("ctid >= '({a},0)'::tid".format(a=a))
+        if not shards:
+            print 'Unable to split {src}, exporting as a single file'.format(src=source)
+            shards = ['1=1']
+
+        base = os.path.splitext(output)[0]
+        report = [None] * len(shards)
+
+        def export(i):
+            shard_file = '{b}_{n}.csv'.format(b=base, n=i)
+            start = time.time()
+            rows = self.stream_query_to_csv('SELECT * FROM {src} WHERE {w}'.format(src=source, w=shards[i]),
+                                            shard_file, sep=sep, quote_strings=quote_strings,
+                                            header=not merge, strict=False)
+            report[i] = (shard_file, rows, time.time() - start)
+
+        print 'Exporting {src} in {n} shards'.format(src=source, n=len(shards))
+        start = time.time()
+        pending = range(len(shards))
+        while pending:
+            threads = [threading.Thread(target=export, args=(i,)) for i in pending[:workers]]
+            pending = pending[workers:]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        elapsed = time.time() - start
+
+        report = pd.DataFrame(report, columns=['file', 'rows', 'seconds'])
+        if report.rows.isnull().any():
+            print 'Failure:\n{n} shards failed to export'.format(n=report.rows.isnull().sum())
+        elif merge:
+            # the header is written here rather than by the first shard, which may be empty
+            columns = self.dfquery('SELECT * FROM {src} WHERE 1=0'.format(src=source)).columns
+            with open(output, 'wb') as ouf:
+                csv.writer(ouf, delimiter=sep, quotechar="'").writerow(
+                    [i.encode('utf-8') if isinstance(i, unicode) else i for i in columns])
+                for shard_file in report.file:
+                    with open(shard_file, 'rb') as inf:
+                        shutil.copyfileobj(inf, ouf)
+                    os.remove(shard_file)
+            report['file'] = output
+        total = report.rows.sum()
+        print '{r} rows written in {t:.1f} seconds ({s:.0f} rows/second)'.format(
+            r=int(total), t=elapsed, s=total / elapsed if elapsed else 0)
+        print report.to_string(index=False)
+        return report
 
     def shp_to_table(self, **kwargs):
         """
@@ -630,52 +1644,71 @@ class DbConnect:
                         shp_name=shp_name, cmd=cmd, srid=srid, gdal_data_loc=gdal_data_loc)
         shp.read_feature_class(private)
 
-    def clean_logs(self):
+    def clean_logs(self, background=False):
+        """
+        Drops expired temp tables recorded in the user's __temp_log_table_<user>__ log tables. 
+        All log tables are found with a single catalog query and the expired tables are dropped in one batch, 
+        on a connection separate from self.conn. 
+        :param background: If True the clean up runs in a daemon thread and this returns immediately
+        :return: Thread running the clean up if background, otherwise None
+        """
+        if background:
+            thread = threading.Thread(target=self.clean_logs)
+            thread.daemon = True
+            thread.start()
+            return thread
         log_table = '__temp_log_table_{}__'.format(self.user)
-        if self.type == 'PG':
-            self.query(" SELECT schema_name FROM information_schema.schemata", timeme=False)
-            for sch in self.queries[-1].data:
-                schema = sch[0]
-                # check if log table exists
-                self.query("""
-                            SELECT EXISTS (
-                            SELECT 1
-                            FROM pg_catalog.pg_tables
-                            WHERE schemaname = '{s}'
-                            AND tablename = '{log}'
-                            )        
-                        """.format(s=schema, log=log_table), timeme=False)
-                x = self.queries[-1].data[0][0]
-                if x:
-                    clean_up_from_log(self, schema, self.user)
-        elif self.type == 'MS':
-            self.query("""
-                select s.name as schema_name, 
-                    s.schema_id,
-                    u.name as schema_owner
-                from sys.schemas s
-                    inner join sys.sysusers u
-                        on u.uid = s.principal_id
-                where u.name not like 'db_%' 
-                    and u.name != 'INFORMATION_SCHEMA' 
-                    and u.name != 'sys'
-                    and u.name != 'guest'
-                order by s.schema_id
-                """)
-            for sch in self.queries[-1].data:
-                schema = sch[0]
-                # check if log table exists
-                self.query("""
-                                SELECT * 
-                                FROM sys.tables t 
-                                JOIN sys.schemas s 
-                                ON t.schema_id = s.schema_id
-                                WHERE s.name = '{s}' AND t.name = '{log}'
-                            """.format(s=schema, log=log_table), timeme=False)
-                if self.queries[-1].data:
-                    x = self.queries[-1].data[0][0]
-                    if x:
-                        clean_up_from_log(self, schema, self.user)
+        conn = self.borrow_connection()
+        failed = False
+        try:
+            cur = conn.cursor()
+            if self.type == 'PG':
+                cur.execute("""
+                    SELECT schemaname
+                    FROM pg_catalog.pg_tables
+                    WHERE tablename = '{log}'
+                """.format(log=log_table))
+            elif self.type == 'MS':
+                cur.execute("""
+                    SELECT s.name
+                    FROM sys.tables t
+                    JOIN sys.schemas s
+                    ON t.schema_id = s.schema_id
+                    WHERE t.name = '{log}'
+                """.format(log=log_table))
+            schemas = [i[0] for i in cur.fetchall()]
+            self.log_schemas.update([(i, self.user) for i in schemas])
+            if schemas:
+                drop_expired_tables(conn, self.type, schemas, self.user)
+        except Exception as e:
+            failed = True
+            print ('Failure:\nTemp table clean up failed\n\t{}'.format(e))
+        finally:
+            self.release_connection(conn, discard=failed)
+
+    def flush_temp_log(self):
+        """
+        Writes buffered temp table log entries (see log_temp_table) in a single round trip. 
+        Log tables that are known to exist for this session are not checked again.
+        :return: None
+        """
+        with self.lock:
+            if not self.pending_logs:
+                return
+            entries, self.pending_logs = self.pending_logs, list()
+        logs = set([(i[0], i[2]) for i in entries])
+        for attempt in range(2):
+            cur = self.conn.cursor()
+            try:
+                cur.execute(';\n'.join(temp_log_statements(self.type, entries, self.log_schemas)))
+                self.conn.commit()
+                self.log_schemas.update(logs)
+                return
+            except Exception as e:
+                self.conn.rollback()
+                # a log table may have been dropped since it was cached, retry creating it
+                self.log_schemas.difference_update(logs)
+        print ('Failure:\nTemp table logging failed\n\t{}'.format(e))
 
     def blocking_me(self):
         """
@@ -736,7 +1769,7 @@ class DbConnect:
                WHERE NOT blocked_locks.GRANTED
                and blocking_activity.usename = '%s'
             """ % self.user)
-            to_kill = [i[0] for i in self.queries[-1].data]
+            to_kill = [i[0] for i in self.data]
             if to_kill:
                 print 'Killing %i connections' % len(to_kill)
                 for pid in tqdm(to_kill):
@@ -773,27 +1806,218 @@ class DbConnect:
         self.tables_created = list()
 
 
-class Query:
+class AsyncDbConnect:
+    """
+    Non-blocking DbConnect. Calls are run on a pool of worker threads, each with its own DbConnect session (so temp 
+    table logging, comments and permissions work exactly as in DbConnect), and return an AsyncResult straight away: 
+    result.get() waits for the value (raising any error), result.ready() tells if it is done and a callback=func 
+    keyword is called with the value once it is. Up to workers calls are in flight at the same time.
+    """
+
     def __str__(self):
-        if self.query_time.seconds == 0:
-            t = self.query_time.microseconds
-            ty = 'microseconds'
-        else:
-            t = self.query_time.seconds
-            ty = 'seconds'
-        if self.data:
-            return '- Query run {dt}\n\tQuery time: {t} {ty}\n\t{q}\n\t* Returned {r} rows *'.format(
-                dt=datetime.datetime.now(),
-                q=self.query_string,
-                r=len(self.data),
-                t=t, ty=ty)
-        else:
-            return '- Query run {dt}\n\tQuery time: {t} {ty}\n\t{q}\n\t* No records returned *'.format(
-                dt=datetime.datetime.now(),
-                q=self.query_string,
-                t=t, ty=ty)
+        return 'Async database connection ({w} workers, {s} sessions open)\n{dbo}'.format(
+            w=self.workers, s=len(self.sessions), dbo=self.dbo)
 
-    def __init__(self, dbo, query_string, **kwargs):
+    def __init__(self, workers=4, **kwargs):
+        """
+
+        :param workers: Number of worker threads (and database sessions) 
+        :param kwargs: DbConnect parameters, missing credentials are asked for once here
+        """
+        self.dbo = DbConnect(**kwargs)
+        self.params = dict(kwargs, type=self.dbo.type, server=self.dbo.server, database=self.dbo.database,
+                           user=self.dbo.user, password=self.dbo.password)
+        self.workers = workers
+        self.sessions = list()
+        self.sessions_lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = ThreadPool(workers)
+
+    def session(self):
+        """
+        Gets the DbConnect of the calling worker thread, connecting on first use. Sessions connect quietly and 
+        skip the temp table clean up, which already ran for self.dbo.
+        :return: DbConnect
+        """
+        dbo = getattr(self.local, 'dbo', None)
+        if dbo is None:
+            dbo = DbConnect(**dict(self.params, quiet=True, clean_up=False))
+            self.local.dbo = dbo
+            with self.sessions_lock:
+                self.sessions.append(dbo)
+        return dbo
+
+    def call(self, method, args, kwargs):
+        """
+        Runs a DbConnect method on the worker's session. A failed strict query exits through sys.exit() in 
+        DbConnect, here it is raised as a RuntimeError from result.get() instead of killing the worker.
+        :param method: DbConnect method name
+        :param args: positional arguments
+        :param kwargs: keyword arguments
+        :return: Return value of the method (query returns the query data)
+        """
+        dbo = self.session()
+        try:
+            value = getattr(dbo, method)(*args, **kwargs)
+        except SystemExit:
+            raise RuntimeError('{m} failed, see the printed failure'.format(m=method))
+        if method == 'query':
+            return dbo.data
+        return value
+
+    def run(self, method, *args, **kwargs):
+        """
+        Runs any DbConnect method in a worker thread
+        :param method: DbConnect method name
+        :param args: positional arguments for the method
+        :param kwargs: keyword arguments for the method, callback (function) is called with the result when done
+        :return: AsyncResult
+        """
+        callback = kwargs.pop('callback', None)
+        return self.pool.apply_async(self.call, (method, args, kwargs), callback=callback)
+
+    def query(self, query, **kwargs):
+        """
+        Runs DbConnect.query in a worker thread
+        :param query: String sql query to be run
+        :param kwargs: DbConnect.query keywords and callback
+        :return: AsyncResult of the query data (None for queries that return no rows)
+        """
+        return self.run('query', query, **kwargs)
+
+    def dfquery(self, query, **kwargs):
+        """
+        Runs DbConnect.dfquery in a worker thread
+        :param query: SQL statement
+        :param kwargs: DbConnect.dfquery keywords and callback
+        :return: AsyncResult of a Pandas DataFrame
+        """
+        return self.run('dfquery', query, **kwargs)
+
+    def query_to_csv(self, query, **kwargs):
+        """
+        Runs DbConnect.query_to_csv in a worker thread
+        :return: AsyncResult
+        """
+        return self.run('query_to_csv', query, **kwargs)
+
+    def dataframe_to_table(self, df, table_name, **kwargs):
+        """
+        Runs DbConnect.dataframe_to_table in a worker thread
+        :return: AsyncResult
+        """
+        return self.run('dataframe_to_table', df, table_name, **kwargs)
+
+    def csv_to_table(self, **kwargs):
+        """
+        Runs DbConnect.csv_to_table in a worker thread
+        :return: AsyncResult
+        """
+        return self.run('csv_to_table', **kwargs)
+
+    def bulk_csv_to_table(self, **kwargs):
+        """
+        Runs DbConnect.bulk_csv_to_table in a worker thread
+        :return: AsyncResult
+        """
+        return self.run('bulk_csv_to_table', **kwargs)
+
+    def iter_query(self, query, batch_size=10000, prefetch=2):
+        """
+        Iterates over the results of a select query in batches, like DbConnect.iter_query. Batches are fetched by 
+        a daemon thread of their own (see DbConnect.stream_query) and up to prefetch batches are read ahead while 
+        the caller works on the current one. The thread is not one of the workers, so the caller can wait on other 
+        calls inside the loop without deadlocking the pool.
+        :param query: SQL select statement
+        :param batch_size: Number of rows per batch (defaults to 10,000)
+        :param prefetch: Number of batches read ahead (defaults to 2)
+        :return: Generator of lists of row tuples
+        """
+        batches = Queue.Queue(prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # gives up once the caller stops iterating, so the thread is not blocked forever
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                # stream_query runs on a connection of its own, self.dbo is not otherwise used
+                for description, rows in self.dbo.stream_query(query, batch_size):
+                    if not put(rows):
+                        return
+            except SystemExit:
+                put(RuntimeError('iter_query failed, see the printed failure'))
+                return
+            except Exception as e:
+                put(e)
+                return
+            put(None)
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                rows = batches.get()
+                if rows is None:
+                    return
+                if isinstance(rows, Exception):
+                    raise rows
+                yield rows
+        finally:
+            stop.set()
+
+    @staticmethod
+    def gather(*results):
+        """
+        Waits for several AsyncResults
+        :param results: AsyncResult objects
+        :return: list of their values, in the same order
+        """
+        return [r.get() for r in results]
+
+    def close(self):
+        """
+        Waits for the running calls, writes any deferred temp log entries and disconnects every session
+        :return: None
+        """
+        self.pool.close()
+        self.pool.join()
+        for dbo in self.sessions + [self.dbo]:
+            if dbo.pending_logs:
+                dbo.flush_temp_log()
+            dbo.disconnect(True)
+        self.sessions = list()
+
+
+class Query:
+    def __str__(self):
+        if self.query_time.seconds == 0:
+            t = self.query_time.microseconds
+            ty = 'microseconds'
+        else:
+            t = self.query_time.seconds
+            ty = 'seconds'
+        if self.data:
+            return '- Query run {dt}\n\tQuery time: {t} {ty}\n\t{q}\n\t* Returned {r} rows *'.format(
+                dt=datetime.datetime.now(),
+                q=self.query_string,
+                r=len(self.data),
+                t=t, ty=ty)
+        else:
+            return '- Query run {dt}\n\tQuery time: {t} {ty}\n\t{q}\n\t* No records returned *'.format(
+                dt=datetime.datetime.now(),
+                q=self.query_string,
+                t=t, ty=ty)
+
+    def __init__(self, dbo, query_string, **kwargs):
         """
 
         :param dbo: DbConnect object 
@@ -804,8 +2028,13 @@ class Query:
             permission (bool): description 
             temp (bool): if True any new tables will be logged for deletion at a future date 
             remove_date (datetime.date): description 
+            columnar (bool): If true results are stored as a ColumnarResult instead of a list of rows
+            conn: Connection to run on instead of dbo.conn (see DbConnect.query_many), on failure it is rolled 
+                back rather than reconnected
         """
         self.dbo = dbo
+        self.own_conn = kwargs.get('conn', None) is not None
+        self.conn = kwargs.get('conn', None) or dbo.conn
         self.query_string = query_string
         self.strict = kwargs.get('strict', True)
         self.permission = kwargs.get('permission', True)
@@ -813,6 +2042,7 @@ class Query:
         self.comment = kwargs.get('comment', '')
         self.no_comment = kwargs.get('no_comment', False)
         self.timeme = kwargs.get('timeme', True)
+        self.columnar = kwargs.get('columnar', False)
         self.query_start = datetime.datetime.now()
         self.query_end = datetime.datetime.now()
         self.query_time = None
@@ -820,11 +2050,18 @@ class Query:
         self.data_description = None
         self.data_columns = None
         self.data = None
+        self.error = None
+        self.data_dropped = False
         self.new_tables = list()
         self.renamed_tables = list()
+        self.dropped_tables = list()
+        self.statement_info = None
+        self.side_effects = list()
+        self.log_entries = list()
         self.query()
         self.auto_comment()
         self.run_table_logging()
+        self.run_side_effects()
 
     def query_time_format(self):
         if self.query_time.seconds < 60:
@@ -844,36 +2081,42 @@ class Query:
         :return: 
         """
         self.query_start = datetime.datetime.now()
-        cur = self.dbo.conn.cursor()
-        self.query_string = self.query_string.replace('%', '%%')
-        self.query_string = self.query_string.replace('-pct-', '%')
-        self.query_string = self.query_string.replace('-qte-chr-', "''")
+        cur = self.conn.cursor()
+        self.query_string = escape_query_string(self.query_string)
         try:
             cur.execute(self.query_string)
         except:
+            self.error = sys.exc_info()[1]
             print ('Failure:\n')
             print ('- Query run {dt}\n\t{q}'.format(
                 dt=datetime.datetime.now(),
                 q=self.query_string))
             del cur
-            cur = self.dbo.conn.cursor()
             if self.strict:
                 sys.exit()
+            elif self.own_conn:
+                self.conn.rollback()
             else:
                 # reset connection
                 self.dbo.disconnect()
                 self.dbo.connect()
+                self.conn = self.dbo.conn
+            cur = self.conn.cursor()
         self.query_end = datetime.datetime.now()
         self.query_time = self.query_end - self.query_start
         if self.timeme:
             print self.query_time_format()
+        self.statement_info = classify_sql(self.query_string)
+        if getattr(self.dbo, 'cache', None) is not None:
+            self.dbo.cache.invalidate_statement(self.statement_info)
         if cur.description is None:
-            self.dbo.conn.commit()
+            self.conn.commit()
             self.new_tables = self.query_creates_table()
             self.renamed_tables = self.query_renames_table()
+            self.dropped_tables = list(self.statement_info.dropped_tables)
             if self.permission:
                 for t in self.new_tables:
-                    self.dbo.query('grant select on {t} to public;'.format(t=t), timeme=False)
+                    self.side_effects.append('grant select on {t} to public'.format(t=t))
             if self.renamed_tables:
                 for i in self.renamed_tables.keys():
                     self.rename_index(i, self.renamed_tables[i])
@@ -892,7 +2135,9 @@ class Query:
         # once when Query is initially created and again to query for the df,
         # so this is a work around for pyodbc
         df = None
-        if self.dbo.type == 'MS':
+        if isinstance(self.data, ColumnarResult):
+            df = self.data.to_pandas()
+        elif self.dbo.type == 'MS':
             self.data = [tuple(i) for i in self.data]
             df = pd.DataFrame(self.data, columns=self.data_columns)
         else:
@@ -908,85 +2153,104 @@ class Query:
         self.has_data = True
         self.data_description = cur.description
         self.data_columns = [desc[0] for desc in self.data_description]
-        self.data = cur.fetchall()
+        if self.columnar:
+            self.data = ColumnarResult.from_cursor(cur, self.dbo.type)
+        else:
+            self.data = cur.fetchall()
 
     def query_creates_table(self):
         """
-        Checks if query generates new tables 
-        :return: list of sets of {[schema.]table}
-        """
-        new_tables = list()
-        create_table = r'(create table\s+)(\[?[\w]*\]?[.]?\"?\[?[\w]*\]?\.?\[?[\w]*\"?\]?([\w]*\]?))'
-        matches = re.findall(create_table, self.query_string.lower())
-        # get all schema and table pairs remove create table match
-        new_tables += [set(_[1:]) for _ in matches]
-        # adds catch for MS [database].[schema].[table]
-        select_into = r'(select[^\.]*into\s+)(\[?[\w]*\]?[.]?\"?\[?[\w]*\]?\.?\[?[\w]*\"?\]?([\w]*\]?))'
-        matches = re.findall(select_into, self.query_string.lower())
-        # [[select ... into], [table], [misc]]
-        new_tables += [set(_[1:]) for _ in matches]
-        # clean up
-        for _ in new_tables:
-            if '' in _:
-                _.remove('')
-        if new_tables and new_tables != [set()]:
-            return [i.pop() for i in new_tables]
-        else:
-            return []
+        Checks if query generates new tables (CREATE TABLE or SELECT INTO, see classify_sql)
+        :return: list of [schema.]table
+        """
+        return list(classify_sql(self.query_string).new_tables)
 
     def query_renames_table(self):
-        new_tables = dict()
-        rename_tables = r'(alter table\s+)([\w]*\.)?([\w]*)\s+(rename to\s+)([\w]*)'
-        matches = re.findall(rename_tables, self.query_string.lower())
-        for row in matches:
-            if row:
-                old_schema = row[1]
-                old_table = row[2]
-                new_table = row[-1]
-                new_tables[old_schema+new_table] = old_table
-        return new_tables
+        """
+        Checks if query renames tables (ALTER TABLE ... RENAME TO, see classify_sql)
+        :return: dict of {[schema.]new_table: old_table}
+        """
+        return dict(classify_sql(self.query_string).renamed_tables)
 
     def rename_index(self, new_table, old_table):
-        # get indecies for new table
+        """
+        Queues renaming the indexes of a renamed table to match the new table name (PG only). 
+        The index lookup and renames run server side in a single statement with the other side effects.
+        :param new_table: New [schema.]table name
+        :param old_table: Old table name
+        :return: None
+        """
+        if self.dbo.type != 'PG':
+            return
         if '.' in new_table:
             sch, tbl = new_table.split('.')
         else:
             tbl = new_table
-            if self.dbo.type =='PG':
-                sch='public'
-            else:
-                sch='dbo'
-        self.dbo.query("""
-            SELECT indexname
-            FROM pg_indexes
-            WHERE tablename = '{t}'
-             AND schemaname='{s}';
-        """.format(t=tbl, s=sch), timeme=False)
-        indecies = self.dbo.data
-        for idx in indecies:
-            if old_table in idx[0]:
-                new_idx = idx[0].replace(old_table, tbl)
-                self.dbo.query("ALTER INDEX IF EXISTS {s}.{i} RENAME to {i2}".format(
-                    s=sch, i=idx[0], i2=new_idx
-                ), timeme=False)
-
+            sch = 'public'
+        # quoted (mixed case) names are matched against the catalog without their quotes
+        sch, tbl, old_table = sch.strip('"'), tbl.strip('"'), old_table.strip('"')
+        self.side_effects.append("""
+            DO $$
+            DECLARE r record;
+            BEGIN
+                FOR r IN SELECT indexname
+                    FROM pg_indexes
+                    WHERE tablename = '{t}'
+                    AND schemaname = '{s}'
+                    AND strpos(indexname, '{o}') > 0
+                LOOP
+                    EXECUTE format('ALTER INDEX IF EXISTS %I.%I RENAME TO %I',
+                        '{s}', r.indexname, replace(r.indexname, '{o}', '{t}'));
+                END LOOP;
+            END $$
+        """.format(t=tbl, s=sch, o=old_table))
 
+    def run_side_effects(self):
+        """
+        Runs the grants, comments, index renames and temp table logging queued for new tables as a single batch 
+        in one transaction on the query's connection. If the batch fails each statement is retried on its own 
+        so one failure (e.g. missing permission to grant) does not stop the rest.
+        :return: None
+        """
+        if not self.side_effects and not self.log_entries:
+            return
+        log_tables = set([(i[0], i[2]) for i in self.log_entries])
+        statements = self.side_effects + temp_log_statements(self.dbo.type, self.log_entries, self.dbo.log_schemas)
+        cur = self.conn.cursor()
+        try:
+            cur.execute(';\n'.join(statements))
+            self.conn.commit()
+            self.dbo.log_schemas.update(log_tables)
+            return
+        except Exception:
+            self.conn.rollback()
+        for statement in self.side_effects:
+            try:
+                cur.execute(statement)
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                print ('Failure:\n- {q}\n\t{e}'.format(q=statement.strip(), e=e))
+        if self.log_entries:
+            with self.dbo.lock:
+                self.dbo.pending_logs += self.log_entries
+                self.dbo.log_schemas.difference_update(log_tables)
+            self.dbo.flush_temp_log()
 
     def auto_comment(self):
         """
-        Automatically generates comment for PostgreSQL tables if created with Query 
+        Automatically generates comment for PostgreSQL tables if created with Query (run with the side effects)
         :return: 
         """
         if self.dbo.type == 'PG' and not self.no_comment:
             for t in self.new_tables:
                 # tables in new_tables list will contain schema if provided, otherwise will default to public
-                q = """COMMENT ON TABLE {t} IS 'Created by {u} on {d}\n{cmnt}'""".format(
+                self.side_effects.append("""COMMENT ON TABLE {t} IS 'Created by {u} on {d}\n{cmnt}'""".format(
                     t=t,
                     u=self.dbo.user,
                     d=self.query_start.strftime('%Y-%m-%d %H:%M'),
                     cmnt=self.comment
-                )
-                _ = Query(self.dbo, q, strict=False, timeme=False)
+                ))
 
     def run_table_logging(self):
         """
@@ -1000,7 +2264,8 @@ class Query:
                     log_temp_table(self.dbo,
                                    table.split('.')[0],
                                    table.split('.')[1],
-                                   self.dbo.user)
+                                   self.dbo.user,
+                                   flush=False)
                 else:
                     if self.dbo.type == 'MS':
                         default_schema = 'dbo'
@@ -1009,7 +2274,12 @@ class Query:
                     log_temp_table(self.dbo,
                                    default_schema,
                                    table,
-                                   self.dbo.user)
+                                   self.dbo.user,
+                                   flush=False)
+            # new tables are written to the log with the other side effects
+            if self.new_tables and not self.dbo.defer_logging:
+                with self.dbo.lock:
+                    self.log_entries, self.dbo.pending_logs = self.dbo.pending_logs, list()
 
     def chunked_write_csv(self, **kwargs):
         """
@@ -1034,23 +2304,20 @@ class Query:
         # break data into chunks
         def chunks(size=100000):
             """
-            Breaks large datasets into smaller subsets
+            Breaks large datasets into smaller subsets, in row order
             :param size: Integer for the size of the chunks (defaults to 100,000)
             :return: Generator for data in 100,000 record chunks (list of lists)
             """
-            n = len(self.data) / size
-            for i in range(0, n):
-                yield self.data[i::n], i
+            for i in range(0, len(self.data), size):
+                yield self.data[i:i + size], i
 
         # write to csv
         l = chunks()
         for (chunk, pos) in l:
             # convert to data frame
             if self.dbo.type == 'MS':
-                self.data = [tuple(i) for i in self.data]
-                df = pd.DataFrame(self.data, columns=self.data_columns)
-            else:
-                df = pd.DataFrame(chunk, columns=self.data_columns)
+                chunk = [tuple(i) for i in chunk]
+            df = pd.DataFrame(chunk, columns=self.data_columns)
             # Only write header for 1st chunk
             if pos == 0:
                 # Write out 1st chunk
@@ -1086,6 +2353,7 @@ class Query:
 
         if len(self.data) > 100000:
             self.chunked_write_csv(**kwargs)
+            return
 
         df = self.dfquery()
         # TODO: convert geom to well known string for outputs
@@ -1111,6 +2379,276 @@ class Query:
         shp.write_shp()
 
 
+class QueryHistory:
+    """
+    Bounded history of Query objects, used for DbConnect.queries. Keeps the last max_queries queries and once 
+    the result data held is over max_bytes, drops the data of the oldest queries (their query string and timing 
+    are kept, and data_dropped is set).
+    """
+
+    def __init__(self, max_queries=1000, max_bytes=256 * 1024 ** 2):
+        """
+
+        :param max_queries: Number of queries kept, None keeps all and 0 keeps none
+        :param max_bytes: Approximate bytes of result data kept, None for no limit
+        """
+        self.max_queries = max_queries
+        self.max_bytes = max_bytes
+        self.queries = deque(maxlen=max_queries)
+        self.sizes = deque(maxlen=max_queries)
+        self.bytes = 0
+
+    def __str__(self):
+        return 'Query history: {n} queries, ~{b} bytes of data'.format(n=len(self.queries), b=self.bytes)
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __iter__(self):
+        return iter(self.queries)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self.queries)[i]
+        return self.queries[i]
+
+    def append(self, qry):
+        """
+        Adds a query to the history, evicting the oldest query or result data if over the limits
+        :param qry: Query object
+        :return: None
+        """
+        if self.max_queries == 0:
+            return
+        if len(self.queries) == self.queries.maxlen:
+            self.bytes -= self.sizes[0]
+        size = data_size(qry.data)
+        self.queries.append(qry)
+        self.sizes.append(size)
+        self.bytes += size
+        if self.max_bytes is None:
+            return
+        # drop data oldest first, the newest query always keeps its data
+        for i in range(len(self.queries) - 1):
+            if self.bytes <= self.max_bytes:
+                break
+            if self.sizes[i]:
+                self.bytes -= self.sizes[i]
+                self.sizes[i] = 0
+                self.queries[i].data = None
+                self.queries[i].data_dropped = True
+
+    def clear(self):
+        self.queries.clear()
+        self.sizes.clear()
+        self.bytes = 0
+
+
+def data_size(data, sample=100):
+    """
+    Approximate memory used by a query result, extrapolated from the first rows
+    :param data: list of rows
+    :param sample: Number of rows measured (defaults to 100)
+    :return: Size in bytes
+    """
+    if isinstance(data, ColumnarResult):
+        return data.nbytes
+    if not data:
+        return 0
+    rows = data[:sample]
+    measured = sum([sys.getsizeof(row) + sum([sys.getsizeof(i) for i in row]) for row in rows])
+    return sys.getsizeof(data) + measured * len(data) // len(rows)
+
+
+SNAPSHOT_EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather', 'pickle': '.pkl'}
+
+
+def write_snapshot(df, path, fmt='parquet'):
+    """
+    Writes a DataFrame snapshot file. Parquet and feather need pyarrow (or fastparquet for parquet), if the engine 
+    is not installed or can not store the data (eg. mixed type object columns) the snapshot is pickled instead.
+    :param df: Pandas DataFrame
+    :param path: File path without extension
+    :param fmt: parquet, feather or pickle
+    :return: (format, file) written, (None, None) if nothing could be written
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    for f in ([fmt, 'pickle'] if fmt != 'pickle' else ['pickle']):
+        out = path + SNAPSHOT_EXTENSIONS[f]
+        try:
+            if f == 'parquet':
+                df.to_parquet(out + '.tmp')
+            elif f == 'feather':
+                df.reset_index(drop=True).to_feather(out + '.tmp')
+            else:
+                df.to_pickle(out + '.tmp')
+        except Exception as e:
+            print 'Could not write {f} snapshot\n\t{e}'.format(f=f, e=e)
+            if os.path.exists(out + '.tmp'):
+                os.remove(out + '.tmp')
+            continue
+        # files are swapped in whole so a snapshot being read is never partly written
+        for ext in SNAPSHOT_EXTENSIONS.values():
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+        os.rename(out + '.tmp', out)
+        return f, out
+    return None, None
+
+
+def read_snapshot(snapshot_file, fmt):
+    """
+    :param snapshot_file: File from write_snapshot()
+    :param fmt: parquet, feather or pickle
+    :return: Pandas DataFrame, None if the file can not be read
+    """
+    try:
+        if fmt == 'parquet':
+            return pd.read_parquet(snapshot_file)
+        elif fmt == 'feather':
+            return pd.read_feather(snapshot_file)
+        return pd.read_pickle(snapshot_file)
+    except Exception as e:
+        print 'Could not read snapshot {f}\n\t{e}'.format(f=snapshot_file, e=e)
+        return None
+
+
+# statement types QueryCache knows the tables of, anything else (EXEC, CALL, DO...) clears the whole cache
+CACHE_SCOPED_STATEMENTS = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'MERGE', 'CREATE', 'ALTER', 'DROP',
+                           'TRUNCATE', 'COPY', 'COMMENT', 'GRANT', 'REVOKE')
+
+
+class QueryCache:
+    """
+    LRU cache of SELECT results, used by DbConnect(cache=True). Entries are keyed on the normalized SQL and the 
+    connection (type, server, port, database, user), expire after ttl seconds and the least recently used entries 
+    are evicted once the cached data is over max_bytes. Queries that change a table (DDL or DML) invalidate every 
+    entry that reads from a table with the same name.
+    Only single SELECT/WITH statements that read from at least one table and write to none are cached, and only 
+    when classify_sql could list every table they read (no set returning functions in FROM). 
+    Selects calling volatile functions (random(), now()...) are cached like any other, pass cache=False for those.
+    """
+
+    def __init__(self, ttl=300, max_bytes=64 * 1024 ** 2):
+        """
+
+        :param ttl: Seconds a result is kept (None keeps results until they are invalidated or evicted)
+        :param max_bytes: Approximate bytes of result data kept, None for no limit
+        """
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # key -> (expires, size, table names, (data, columns))
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return 'Query cache: {n} results ({b} bytes), {h} hits, {m} misses, {i} invalidated'.format(
+            n=len(self.entries), b=self.bytes, h=self.hits, m=self.misses, i=self.invalidations)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(dbo, query_string, columnar=False):
+        """
+        :param dbo: DbConnect object
+        :param query_string: SQL string
+        :param columnar: Whether the result is stored as a ColumnarResult
+        :return: Cache key
+        """
+        # whitespace is collapsed and the trailing semicolon dropped, quoted text is left as is
+        sql = SQL_QUOTED_OR_SPACE.sub(lambda m: m.group(1) or ' ', query_string).strip().rstrip(';').strip()
+        return dbo.type, dbo.server, dbo.port, dbo.database, dbo.user, sql, columnar
+
+    @staticmethod
+    def cacheable(info):
+        """
+        :param info: StatementInfo from classify_sql()
+        :return: True if the results of the statement can be cached
+        """
+        return (len(info.statement_types) == 1 and info.statement_types[0] in ('SELECT', 'WITH') and
+                info.complete and bool(info.read_tables) and not info.written_tables())
+
+    def get(self, key):
+        """
+        :param key: Cache key from QueryCache.key()
+        :return: Cached (data, columns) or None
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry and (entry[0] is None or entry[0] > time.time()):
+                self.entries[key] = entry
+                self.hits += 1
+                return entry[3]
+            if entry:
+                self.bytes -= entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, qry):
+        """
+        Caches the results of a Query. The rows are copied (as tuples) so the entry does not change when the Query 
+        is dropped from or trimmed in the query history.
+        :param key: Cache key from QueryCache.key()
+        :param qry: Query object
+        :return: None
+        """
+        if isinstance(qry.data, ColumnarResult):
+            data = qry.data
+        else:
+            data = [tuple(i) for i in qry.data]
+        size = data_size(data)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        tables = set([t.split('.')[-1] for t in qry.statement_info.read_tables])
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.bytes -= old[1]
+            self.entries[key] = (expires, size, tables, (data, list(qry.data_columns)))
+            self.bytes += size
+            while self.max_bytes is not None and self.bytes > self.max_bytes:
+                _, entry = self.entries.popitem(last=False)
+                self.bytes -= entry[1]
+
+    def invalidate(self, tables=None):
+        """
+        Drops cached results that read from any of the tables (matched on table name, ignoring the schema)
+        :param tables: list of [schema.]table names, None drops everything
+        :return: None
+        """
+        names = set([t.split('.')[-1] for t in tables]) if tables is not None else None
+        with self.lock:
+            for key, entry in self.entries.items():
+                if names is None or names & entry[2]:
+                    del self.entries[key]
+                    self.bytes -= entry[1]
+                    self.invalidations += 1
+
+    def invalidate_statement(self, info):
+        """
+        Drops cached results made stale by a statement
+        :param info: StatementInfo from classify_sql()
+        :return: None
+        """
+        if [i for i in info.statement_types if i not in CACHE_SCOPED_STATEMENTS]:
+            self.invalidate()
+        else:
+            written = info.written_tables()
+            if written:
+                self.invalidate(written)
+
+    def clear(self):
+        self.invalidate()
+
+
 class Shapefile:
     def __str__(self):
         pass
@@ -1173,7 +2711,7 @@ class Shapefile:
         # check if table exists
         self.dbo.query("SELECT table_name FROM information_schema.tables WHERE table_schema = '{s}'".format(
             s=self.schema))
-        if self.shp_name.replace('.shp', '').lower() in [i[0] for i in self.dbo.queries[-1].data]:
+        if self.shp_name.replace('.shp', '').lower() in [i[0] for i in self.dbo.data]:
             exists = True
         else:
             exists = False
@@ -1194,7 +2732,7 @@ class Shapefile:
                 and t.relname = '{t}'
         """.format(
             t=self.shp_name.replace('.shp', '').lower()))
-        idx = self.dbo.queries[-1].data
+        idx = self.dbo.data
         for row in idx:
             if 'pkey' not in row[1]:
                 self.dbo.query('DROP INDEX IF EXISTS "{s}"."{i}"'.format(
@@ -1303,7 +2841,7 @@ class Shapefile:
             WHERE table_schema = '{s}'
             AND table_name   = '{t}';
         """.format(s=self.schema, t=self.table))
-        if 'wkb_geometry' in [i[0] for i in self.dbo.queries[-1].data]:
+        if 'wkb_geometry' in [i[0] for i in self.dbo.data]:
             # rename column
             self.dbo.query("""
                 ALTER TABLE {s}.{t} 
@@ -1317,6 +2855,475 @@ class Shapefile:
             """.format(s=self.schema, t=self.table))
 
 
+class ConnectionPool:
+    """
+    Pool of open database connections shared by DbConnect instances with the same credentials.
+    Connections are health checked on checkout and closed once they have sat idle past the idle timeout.
+    """
+
+    def __init__(self, connect_fn, db_type, **kwargs):
+        """
+
+        :param connect_fn: Function that opens a new raw connection
+        :param db_type: Database type (PG/MS)
+        :param kwargs:
+            min_size (int): Number of connections kept open (defaults to 1)
+            max_size (int): Maximum number of connections checked out at once (defaults to 10)
+            idle_timeout (int): Seconds an idle connection above min_size is kept before closing (defaults to 300)
+            check_after (int): Seconds idle after which a connection is pinged on checkout (defaults to 5)
+        """
+        self.connect_fn = connect_fn
+        self.type = db_type
+        self.min_size = kwargs.get('min_size', 1)
+        self.max_size = max(kwargs.get('max_size', 10), self.min_size, 1)
+        self.idle_timeout = kwargs.get('idle_timeout', 300)
+        self.check_after = kwargs.get('check_after', 5)
+        self.idle = list()
+        self.in_use = 0
+        self.lock = threading.Condition()
+        for _ in range(self.min_size):
+            self.idle.append((self.connect_fn(), time.time()))
+
+    def __str__(self):
+        return 'Connection pool ({typ}) - {i} idle, {u} in use, max {m}'.format(
+            typ=self.type, i=len(self.idle), u=self.in_use, m=self.max_size)
+
+    def checkout(self, timeout=None):
+        """
+        Borrows a connection from the pool, opening a new one if none are idle and the pool is not full
+        :param timeout: Seconds to wait for a connection when the pool is exhausted (defaults to wait forever)
+        :return: psycopg2 or pyodbc connection
+        """
+        conn, returned = None, None
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            while True:
+                self.prune()
+                if self.idle:
+                    # most recently returned connection is the warmest
+                    conn, returned = self.idle.pop()
+                    self.in_use += 1
+                    break
+                if self.in_use < self.max_size:
+                    self.in_use += 1
+                    break
+                if deadline is None:
+                    self.lock.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise RuntimeError('Timed out waiting for a pooled connection')
+                    self.lock.wait(remaining)
+        if conn is not None and not self.healthy(conn, returned):
+            self.close_connection(conn)
+            conn = None
+        if conn is None:
+            try:
+                conn = self.connect_fn()
+            except:
+                with self.lock:
+                    self.in_use -= 1
+                    self.lock.notify()
+                raise
+        return conn
+
+    def checkin(self, conn, discard=False):
+        """
+        Returns a connection to the pool. Any open transaction is rolled back so the connection does not block.
+        :param conn: Connection previously returned by checkout()
+        :param discard: If True the connection is closed instead of being reused
+        :return: None
+        """
+        if conn is None:
+            return
+        if not discard:
+            try:
+                conn.rollback()
+            except:
+                discard = True
+        if discard:
+            self.close_connection(conn)
+        with self.lock:
+            self.in_use = max(self.in_use - 1, 0)
+            if not discard:
+                self.idle.append((conn, time.time()))
+            self.lock.notify()
+
+    def healthy(self, conn, returned):
+        """
+        Checks a connection before it is handed out
+        :param conn: Connection
+        :param returned: Time the connection was returned to the pool
+        :return: True if the connection is usable
+        """
+        if self.type == 'PG' and conn.closed:
+            return False
+        if returned is not None and time.time() - returned < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.fetchall()
+            conn.rollback()
+            return True
+        except:
+            return False
+
+    def prune(self):
+        """
+        Closes connections above min_size that have been idle longer than idle_timeout (call with lock held)
+        :return: None
+        """
+        now = time.time()
+        keep = list()
+        # idle list is ordered oldest to newest
+        for i, (conn, returned) in enumerate(self.idle):
+            if now - returned > self.idle_timeout and len(self.idle) - i + len(keep) > self.min_size:
+                self.close_connection(conn)
+            else:
+                keep.append((conn, returned))
+        self.idle = keep
+
+    def close_connection(self, conn):
+        try:
+            conn.close()
+        except:
+            pass
+
+    def close(self):
+        """
+        Closes all idle connections in the pool
+        :return: None
+        """
+        with self.lock:
+            for conn, _ in self.idle:
+                self.close_connection(conn)
+            self.idle = list()
+
+
+def get_connection_pool(dbo):
+    """
+    Gets (or creates) the ConnectionPool for the DbConnect's credentials
+    :param dbo: DbConnect object
+    :return: ConnectionPool
+    """
+    key = (dbo.type, dbo.server, dbo.port, dbo.database, dbo.user, os.getpid())
+    with CONNECTION_POOLS_LOCK:
+        if key not in CONNECTION_POOLS:
+            CONNECTION_POOLS[key] = ConnectionPool(dbo.open_connection,
+                                                   dbo.type,
+                                                   min_size=dbo.pool_min,
+                                                   max_size=dbo.pool_max,
+                                                   idle_timeout=dbo.pool_idle_timeout)
+        return CONNECTION_POOLS[key]
+
+
+def close_connection_pools():
+    """
+    Closes the idle connections of every pool of this process and removes them from the pool registry 
+    (pools inherited from a parent process are left alone)
+    :return: None
+    """
+    with CONNECTION_POOLS_LOCK:
+        for key in CONNECTION_POOLS.keys():
+            if key[-1] == os.getpid():
+                CONNECTION_POOLS.pop(key).close()
+
+
+def init_map_worker(dbo):
+    """
+    Process pool initializer for DbConnect.map_query, keeps the worker's DbConnect
+    :param dbo: DbConnect object (pickled or inherited, it reconnects on first use)
+    :return: None
+    """
+    global WORKER_DBO
+    WORKER_DBO = dbo
+
+
+def run_map_worker(func, df):
+    """
+    Runs one DbConnect.map_query chunk in a worker process
+    :param func: function(Pandas DataFrame, DbConnect)
+    :param df: Pandas DataFrame
+    :return: Return value of func
+    """
+    return func(df, WORKER_DBO)
+
+
+# Statement classifier used by Query. SQL_SCAN finds only the tokens the classifier cares about (keywords, parens,
+# statement ends) and skips comments, string literals, dollar quoted bodies and quoted identifiers in the same pass.
+SQL_SCAN = re.compile(r"""
+    (?P<skip>--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|\$(?P<tag>\w*)\$.*?\$(?P=tag)\$|"(?:[^"]|"")*"|\[[^\]]*\])
+    |(?P<end>;)
+    |(?P<open>\()
+    |(?P<close>\))
+    |(?P<comma>,)
+    |\b(?P<kw>create|alter|drop|select|into|insert|merge|update|delete|from|join|truncate|copy|with)\b
+    |\b(?P<clause>where|group|having|order|limit|offset|fetch|union|intersect|except|window|returning|for)\b
+""", re.I | re.S | re.X)
+SQL_NAME = r'(?:"(?:[^"]|"")*"|\[[^\]]*\]|[\w#$@]+)(?:\s*\.\s*(?:"(?:[^"]|"")*"|\[[^\]]*\]|[\w#$@]+)){0,2}'
+SQL_NAME_PART = re.compile(r'"((?:[^"]|"")*)"|\[([^\]]*)\]|([\w#$@]+)')
+SQL_FIRST_WORD = re.compile(r'(?:\s|--[^\n]*|/\*.*?\*/)*([a-z_]+)', re.I | re.S)
+SQL_CREATE_TABLE = re.compile(r'\s+(?:unlogged\s+)?table\s+(?:if\s+not\s+exists\s+)?(' + SQL_NAME + ')', re.I)
+SQL_RENAME_TABLE = re.compile(r'\s+table\s+(?:if\s+exists\s+)?(?:only\s+)?(' + SQL_NAME + r')\s+rename\s+to\s+(' +
+                              SQL_NAME + ')', re.I)
+SQL_DROP_TABLE = re.compile(r'\s+table\s+(?:if\s+exists\s+)?(' + SQL_NAME + r'(?:\s*,\s*' + SQL_NAME + ')*)', re.I)
+SQL_INTO = re.compile(r'\s+(' + SQL_NAME + ')', re.I)
+# SELECT INTO [TEMP | TEMPORARY | UNLOGGED] [TABLE] name, group 1 is set for temp tables
+SQL_SELECT_INTO = re.compile(r'\s+(?:(temp|temporary)\s+|unlogged\s+)?(?:table\s+)?(' + SQL_NAME + ')', re.I)
+# UPDATE/DELETE as the action of ON CONFLICT DO or MERGE WHEN ... THEN, they have no table name of their own
+SQL_ACTION_CLAUSE = re.compile(r'\b(?:do|then)\s+$', re.I)
+SQL_PLAIN_NAME = re.compile(r'^[a-z_][a-z0-9_$]*$')
+SQL_ALTER_TABLE = re.compile(r'\s+table\s+(?:if\s+exists\s+)?(?:only\s+)?(' + SQL_NAME + ')', re.I)
+SQL_TRUNCATE_TABLE = re.compile(r'\s+(?:table\s+)?(?:only\s+)?(' + SQL_NAME + ')', re.I)
+# item of a FROM list or JOIN: a subquery (group 1), a table (group 2) or a function call (group 2 and 3)
+SQL_FROM_ITEM = re.compile(r'\s*(?:only\s+)?(?:lateral\s+)?(?:(\()|(' + SQL_NAME + r')\s*(\()?)', re.I)
+# CTE definition after WITH or a comma: [RECURSIVE] name [(columns)] AS [[NOT] MATERIALIZED] (
+SQL_CTE = re.compile(r'\s*(?:recursive\s+)?(' + SQL_NAME + r')\s*(?:\([^()]*\)\s*)?as\s*'
+                     r'(?:(?:not\s+)?materialized\s*)?\(', re.I)
+# word before a paren, the paren is a function call (extract(year FROM d)) unless the word is one of these
+SQL_PAREN_WORD = re.compile(r'([\w$]+)\s*$')
+SQL_PAREN_KEYWORDS = set(['from', 'join', 'in', 'exists', 'as', 'any', 'all', 'some', 'array', 'values', 'select',
+                          'where', 'and', 'or', 'not', 'on', 'using', 'lateral', 'union', 'except', 'intersect',
+                          'when', 'then', 'else', 'is', 'by', 'having', 'set', 'return', 'materialized'])
+SQL_DISTINCT_BEFORE = re.compile(r'\bdistinct\s+$', re.I)
+SQL_QUOTED_OR_SPACE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|\[[^\]]*\])|\s+""")
+SQL_ESCAPES = re.compile(r'%|-pct-|-qte-chr-')
+SQL_ESCAPE_VALUES = {'%': '%%', '-pct-': '%', '-qte-chr-': "''"}
+CLASSIFY_CACHE = OrderedDict()
+CLASSIFY_CACHE_LOCK = threading.Lock()
+CLASSIFY_CACHE_SIZE = 256
+
+
+class StatementInfo:
+    """
+    What a SQL string does, as reported by classify_sql()
+    """
+
+    def __init__(self):
+        self.statement_types = list()
+        self.new_tables = list()
+        self.renamed_tables = dict()
+        self.dropped_tables = list()
+        self.read_tables = list()
+        self.modified_tables = list()
+        # False when a statement reads from something the scanner can not list (set returning functions, 
+        # unparsed FROM items), read_tables is then incomplete
+        self.complete = True
+
+    def __str__(self):
+        return ('Statements: {s}\n\tNew tables: {n}\n\tRenamed tables: {r}\n\tDropped tables: {d}'
+                '\n\tRead tables: {rd}\n\tModified tables: {m}').format(
+            s=', '.join(self.statement_types), n=self.new_tables, r=self.renamed_tables, d=self.dropped_tables,
+            rd=self.read_tables, m=self.modified_tables)
+
+    def written_tables(self):
+        """
+        :return: Every table the statements create, rename, drop or change the rows of
+        """
+        return (self.new_tables + self.dropped_tables + self.modified_tables +
+                self.renamed_tables.keys() + self.renamed_tables.values())
+
+
+def escape_query_string(query_string):
+    """
+    Applies the pysqldb escapes in one pass: % is doubled, -pct- becomes % and -qte-chr- becomes ''
+    :param query_string: SQL string
+    :return: Escaped SQL string
+    """
+    return SQL_ESCAPES.sub(lambda m: SQL_ESCAPE_VALUES[m.group(0)], query_string)
+
+
+def sql_literal(value):
+    """
+    Formats a cleaned cell value (see DbConnect.clean_dataframe) as a SQL literal for a VALUES list. 
+    Text is quoted as is, so non-ascii characters are written as text rather than as python escapes.
+    :param value: None, number, bool or (utf-8) string
+    :return: String
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    if isinstance(value, (int, long, np.integer)):
+        return str(value)
+    if isinstance(value, (float, np.floating)):
+        return repr(float(value))
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def sql_table_name(name):
+    """
+    Normalizes a (possibly quoted) [database.][schema.]table name to [schema.]table. Unquoted names are lower 
+    cased. Quoted names that PG would not fold to the same name (mixed case, spaces) keep their quotes and case, 
+    so the result can still be used in SQL; MS [bracketed] names are case insensitive and only keep their brackets 
+    if they are not plain identifiers.
+    :param name: Table name as written in the SQL
+    :return: String
+    """
+    parts = list()
+    for m in SQL_NAME_PART.finditer(name):
+        if m.group(1) is not None:
+            part = m.group(1) if SQL_PLAIN_NAME.match(m.group(1)) else '"{}"'.format(m.group(1))
+        elif m.group(2) is not None:
+            part = m.group(2).lower() if re.match(r'^[\w#$@]+$', m.group(2)) else '[{}]'.format(m.group(2))
+        else:
+            part = m.group(3).lower()
+        parts.append(part)
+    return '.'.join(parts[-2:])
+
+
+def classify_sql(query_string):
+    """
+    Classifies a SQL string in a single pass, ignoring comments and string literals. 
+    Results are cached (LRU, keyed by a hash of the SQL) so repeated statements are only scanned once.
+    :param query_string: SQL string
+    :return: StatementInfo with the statement types, the created, renamed and dropped tables and the tables read 
+        from (FROM/JOIN) or written to (INSERT/UPDATE/DELETE/MERGE/TRUNCATE/ALTER/COPY)
+    """
+    key = hashlib.sha1(query_string.encode('utf-8') if isinstance(query_string, unicode) else query_string
+                       ).hexdigest()
+    with CLASSIFY_CACHE_LOCK:
+        if key in CLASSIFY_CACHE:
+            info = CLASSIFY_CACHE.pop(key)
+            CLASSIFY_CACHE[key] = info
+            return info
+    info = StatementInfo()
+    depth = 0
+    # last select/insert/merge/update/delete keyword seen at each paren depth, to tell SELECT INTO from INSERT INTO
+    last_dml = dict()
+    # parens that are function calls, and the depths where a FROM list or the CTEs of a WITH are being read
+    calls = dict()
+    from_lists = set()
+    with_lists = set()
+    ctes = set()
+    statement_start = 0
+    reads_start = 0
+
+    def read_from_item(pos):
+        found = SQL_FROM_ITEM.match(query_string, pos)
+        if not found or (found.group(2) and found.group(3)):
+            # set returning functions (and anything unparsed) may read any table
+            info.complete = False
+        elif found.group(2):
+            info.read_tables.append(sql_table_name(found.group(2)))
+
+    for m in SQL_SCAN.finditer(query_string):
+        if m.group('skip'):
+            continue
+        if m.group('end'):
+            word = SQL_FIRST_WORD.match(query_string, statement_start, m.start())
+            if word:
+                info.statement_types.append(word.group(1).upper())
+            # names defined by WITH are not tables
+            info.read_tables[reads_start:] = [t for t in info.read_tables[reads_start:] if t not in ctes]
+            reads_start = len(info.read_tables)
+            statement_start = m.end()
+            depth = 0
+            last_dml = dict()
+            calls = dict()
+            from_lists = set()
+            with_lists = set()
+            ctes = set()
+        elif m.group('open'):
+            depth += 1
+            word = SQL_PAREN_WORD.search(query_string, max(m.start() - 64, 0), m.start())
+            calls[depth] = bool(word) and word.group(1).lower() not in SQL_PAREN_KEYWORDS
+        elif m.group('close'):
+            last_dml.pop(depth, None)
+            calls.pop(depth, None)
+            from_lists.discard(depth)
+            with_lists.discard(depth)
+            depth = max(depth - 1, 0)
+        elif m.group('comma'):
+            if depth in from_lists:
+                read_from_item(m.end())
+            elif depth in with_lists:
+                found = SQL_CTE.match(query_string, m.end())
+                if found:
+                    ctes.add(sql_table_name(found.group(1)))
+        elif m.group('clause'):
+            from_lists.discard(depth)
+        else:
+            kw = m.group('kw').lower()
+            if kw == 'create':
+                found = SQL_CREATE_TABLE.match(query_string, m.end())
+                # MS #temp tables go away with the session, they are not granted or logged
+                if found and not found.group(1).startswith('#'):
+                    info.new_tables.append(sql_table_name(found.group(1)))
+            elif kw == 'alter':
+                found = SQL_RENAME_TABLE.match(query_string, m.end())
+                if found:
+                    old = sql_table_name(found.group(1))
+                    old_schema = old.rsplit('.', 1)[0] + '.' if '.' in old else ''
+                    info.renamed_tables[old_schema + sql_table_name(found.group(2))] = old.split('.')[-1]
+                else:
+                    found = SQL_ALTER_TABLE.match(query_string, m.end())
+                    if found:
+                        info.modified_tables.append(sql_table_name(found.group(1)))
+            elif kw == 'drop':
+                found = SQL_DROP_TABLE.match(query_string, m.end())
+                if found:
+                    info.dropped_tables += [sql_table_name(i) for i in
+                                            re.findall(SQL_NAME, found.group(1))]
+            elif kw == 'with':
+                found = SQL_CTE.match(query_string, m.end())
+                if found:
+                    ctes.add(sql_table_name(found.group(1)))
+                    with_lists.add(depth)
+            elif kw == 'into':
+                if last_dml.get(depth) == 'select':
+                    found = SQL_SELECT_INTO.match(query_string, m.end())
+                    # PG temp and MS #temp tables go away with the session
+                    if found and not found.group(1) and not found.group(2).startswith('#'):
+                        info.new_tables.append(sql_table_name(found.group(2)))
+                elif last_dml.get(depth) in ('insert', 'merge'):
+                    found = SQL_INTO.match(query_string, m.end())
+                    if found:
+                        info.modified_tables.append(sql_table_name(found.group(1)))
+            elif kw in ('from', 'join'):
+                # FROM inside function calls (extract, substring, trim), IS DISTINCT FROM and COPY ... FROM file
+                if calls.get(depth) or last_dml.get(depth) == 'copy' or \
+                        SQL_DISTINCT_BEFORE.search(query_string, max(m.start() - 16, 0), m.start()):
+                    continue
+                if kw == 'from' and last_dml.get(depth) == 'delete':
+                    found = SQL_INTO.match(query_string, m.end())
+                    if found:
+                        info.modified_tables.append(sql_table_name(found.group(1)))
+                else:
+                    from_lists.add(depth)
+                    read_from_item(m.end())
+            elif kw in ('truncate', 'copy'):
+                # COPY table TO is only a read, it is counted as a write to stay on the safe side
+                found = SQL_TRUNCATE_TABLE.match(query_string, m.end())
+                if found:
+                    info.modified_tables.append(sql_table_name(found.group(1)))
+                last_dml[depth] = kw
+            elif kw in ('update', 'delete') and SQL_ACTION_CLAUSE.search(query_string, max(m.start() - 16, 0),
+                                                                         m.start()):
+                # ON CONFLICT DO UPDATE SET / WHEN MATCHED THEN DELETE change the INSERT/MERGE target
+                continue
+            else:
+                if kw in ('update', 'delete'):
+                    found = SQL_INTO.match(query_string, m.end())
+                    if found and found.group(1).lower() != 'from':
+                        info.modified_tables.append(sql_table_name(found.group(1)))
+                # the statement after the CTEs has started
+                with_lists.discard(depth)
+                last_dml[depth] = kw
+    word = SQL_FIRST_WORD.match(query_string, statement_start)
+    if word:
+        info.statement_types.append(word.group(1).upper())
+    info.read_tables[reads_start:] = [t for t in info.read_tables[reads_start:] if t not in ctes]
+    with CLASSIFY_CACHE_LOCK:
+        CLASSIFY_CACHE[key] = info
+        while len(CLASSIFY_CACHE) > CLASSIFY_CACHE_SIZE:
+            CLASSIFY_CACHE.popitem(last=False)
+    return info
+
+
 def file_loc(typ='file', print_message=None):
     if not print_message:
         print 'File/folder search dialog...'
@@ -1341,55 +3348,88 @@ def file_loc(typ='file', print_message=None):
         return output_file_name
 
 
-def log_temp_table(dbo, schema, table, owner, expiration=datetime.datetime.now() + datetime.timedelta(days=7)):
+def log_temp_table(dbo, schema, table, owner, expiration=None, flush=True):
+    """
+    Records a table in the owner's temp log table so it is dropped once it expires. 
+    Entries are buffered on the DbConnect and written by DbConnect.flush_temp_log().
+    :param dbo: DbConnect object
+    :param schema: Schema of the table (the log table lives in the same schema)
+    :param table: Table name
+    :param owner: User that owns the log table
+    :param expiration: Datetime after which the table can be dropped (defaults to 7 days from now)
+    :param flush: If True the buffered entries are written straight away
+    :return: None
+    """
     log_table = '__temp_log_table_{}__'.format(owner)
-    # check if log exists if not make one
-    if dbo.type == 'MS':
-        dbo.query("""
-                SELECT * 
-                FROM sys.tables t 
-                JOIN sys.schemas s 
-                ON t.schema_id = s.schema_id
-                WHERE s.name = '{s}' AND t.name = '{log}'
-            """.format(s=schema, log=log_table), timeme=False)
-        if not dbo.queries[-1].data:
-            dbo.query("""
-                CREATE TABLE {s}.{log} (
-                    tbl_id int IDENTITY(1,1) PRIMARY KEY,
-                    table_owner varchar(255),
-                    table_schema varchar(255),
-                    table_name varchar(255),
-                    created_on datetime, 
-                    expires date
-                )
-            """.format(s=schema, log=log_table), timeme=False)
-    elif dbo.type == 'PG':
-        # useed the check rather than create if not exists because it was breaking my auto_comment
-        dbo.query("""
-            SELECT EXISTS (
-            SELECT 1
-            FROM pg_catalog.pg_tables
-            WHERE schemaname = '{s}'
-            AND tablename = '{log}'
-            )        
-        """.format(s=schema, log=log_table), timeme=False)
-        x = dbo.queries[-1].data[0][0]
-        if not x:
-            dbo.query("""
-                CREATE TABLE {s}.{log}  (
-                    tbl_id SERIAL,
-                    table_owner varchar,
-                    table_schema varchar,
-                    table_name varchar,
-                    created_on timestamp, 
-                    expires date, 
-                    primary key (table_schema, table_name)
-                    )
-                """.format(s=schema, log=log_table), timeme=False)
-    # add new table to log
+    if not expiration:
+        expiration = datetime.datetime.now() + datetime.timedelta(days=7)
     if table != log_table:
-        if dbo.type == 'PG':
-            dbo.query("""
+        with dbo.lock:
+            dbo.pending_logs.append((schema, table, owner, expiration))
+    if flush:
+        dbo.flush_temp_log()
+
+
+def temp_log_statements(db_type, entries, log_schemas):
+    """
+    Builds the sql to record temp log entries: one statement per schema creating the log table (only for schemas
+    not in log_schemas) and one multi-row upsert per log table.
+    :param db_type: Database type (PG/MS)
+    :param entries: list of (schema, table, owner, expiration) tuples
+    :param log_schemas: set of (schema, owner) log tables already known to exist
+    :return: list of sql statements
+    """
+    created_on = datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+    logs = dict()
+    for schema, table, owner, expiration in entries:
+        # later entries for the same table win, an upsert can not touch a row twice
+        logs.setdefault((schema, owner), dict())[table] = expiration
+    statements = list()
+    for (schema, owner), tables in sorted(logs.items()):
+        log_table = '__temp_log_table_{}__'.format(owner)
+        if (schema, owner) not in log_schemas:
+            if db_type == 'MS':
+                statements.append("""
+                    IF OBJECT_ID('{s}.{log}', 'U') IS NULL
+                    CREATE TABLE {s}.{log} (
+                        tbl_id int IDENTITY(1,1) PRIMARY KEY,
+                        table_owner varchar(255),
+                        table_schema varchar(255),
+                        table_name varchar(255),
+                        created_on datetime, 
+                        expires date
+                    )
+                """.format(s=schema, log=log_table))
+            else:
+                statements.append("""
+                    CREATE TABLE IF NOT EXISTS {s}.{log}  (
+                        tbl_id SERIAL,
+                        table_owner varchar,
+                        table_schema varchar,
+                        table_name varchar,
+                        created_on timestamp, 
+                        expires date, 
+                        primary key (table_schema, table_name)
+                    )
+                """.format(s=schema, log=log_table))
+        values = ',\n'.join(["('{u}', '{s}', '{t}', '{dt}', '{ex}')".format(
+            u=owner, s=schema, t=table, dt=created_on, ex=expiration) for table, expiration in sorted(tables.items())])
+        if db_type == 'MS':
+            statements.append("""
+                MERGE {s}.{log} AS [Target] 
+                USING (VALUES {v}
+                ) AS [Source] (table_owner, table_schema, table_name, created_on, expires)
+                ON [Target].table_schema = [Source].table_schema 
+                    and [Target].table_name = [Source].table_name 
+                WHEN MATCHED THEN UPDATE 
+                    SET [Target].created_on = [Source].created_on,
+                    [Target].expires = [Source].expires
+                WHEN NOT MATCHED THEN INSERT (table_owner, table_schema, table_name, created_on, expires) 
+                    VALUES ([Source].table_owner, [Source].table_schema, [Source].table_name, 
+                        [Source].created_on, [Source].expires);
+            """.format(s=schema, log=log_table, v=values))
+        else:
+            statements.append("""
                 INSERT INTO {s}.{log} (
                     table_owner,
                     table_schema,
@@ -1397,69 +3437,92 @@ def log_temp_table(dbo, schema, table, owner, expiration=datetime.datetime.now()
                     created_on , 
                     expires
                 )
-                VALUES (
-                    '{u}',
-                    '{s}',
-                    '{t}',
-                    '{dt}',
-                    '{ex}'
-                )
-            ON CONFLICT (table_schema, table_name) DO 
-            UPDATE SET expires = EXCLUDED.expires, created_on=EXCLUDED.created_on
-            """.format(
-                s=schema,
-                log=log_table,
-                u=owner,
-                t=table,
-                dt=datetime.datetime.now().strftime('%Y-%m-%d %H:%M'),
-                ex=expiration
-            ), strict=False, timeme=False)
-        elif dbo.type == 'MS':
-            dbo.query("""
-            MERGE dbo.__temp_log_table_risadmin__ AS [Target] 
-            USING (
-                SELECT 
-                    '{u} 'as table_owner,
-                    '{s}' as table_schema,
-                    '{t}' as table_name,
-                    '{dt}' as created_on , 
-                    '{ex}' as expires
-            ) AS [Source] ON [Target].table_schema = [Source].table_schema 
-                and [Target].table_name = [Source].table_name 
-            WHEN MATCHED THEN UPDATE 
-                SET [Target].created_on = [Source].created_on,
-                [Target].expires = [Source].expires
-            WHEN NOT MATCHED THEN INSERT (table_owner, table_schema, table_name, created_on, expires) 
-                VALUES ([Source].table_owner, [Source].table_schema, [Source].table_name, 
-                    [Source].created_on, [Source].expires);
-            """.format(
-                s=schema,
-                log=log_table,
-                u=owner,
-                t=table,
-                dt=datetime.datetime.now().strftime('%Y-%m-%d %H:%M'),
-                ex=expiration
-            ), strict=False, timeme=False)
+                VALUES {v}
+                ON CONFLICT (table_schema, table_name) DO 
+                UPDATE SET expires = EXCLUDED.expires, created_on=EXCLUDED.created_on
+            """.format(s=schema, log=log_table, v=values))
+    return statements
 
 
 def clean_up_from_log(dbo, schema, owner):
+    """
+    Drops expired tables listed in the owner's log table in schema
+    :param dbo: DbConnect object
+    :param schema: Schema of the log table
+    :param owner: User that owns the log table
+    :return: Number of tables dropped
+    """
+    return drop_expired_tables(dbo.conn, dbo.type, [schema], owner)
+
+
+def drop_expired_tables(conn, db_type, schemas, owner):
+    """
+    Drops every expired table listed in the owner's log tables and removes them from the logs. 
+    The expired tables are read with one query and dropped in one batch; if the batch fails (locked table, 
+    missing permissions) each log table / table is handled on its own so one failure does not block the rest.
+    :param conn: Open psycopg2 or pyodbc connection
+    :param db_type: Database type (PG/MS)
+    :param schemas: Schemas that have a log table
+    :param owner: User that owns the log tables
+    :return: Number of tables dropped
+    """
     log_table = '__temp_log_table_{}__'.format(owner)
-    dbo.query("""
-        SELECT table_schema, table_name FROM {s}.{l}
-        WHERE expires < '{dt}'
-        """.format(
-        s=schema,
-        l=log_table,
-        dt=datetime.datetime.now().strftime('%Y-%m-%d')
-    ), timeme=False)
-    to_clean = dbo.queries[-1].data
+    dt = datetime.datetime.now().strftime('%Y-%m-%d')
+    cur = conn.cursor()
+    selects = ["SELECT table_schema, table_name FROM {s}.{l} WHERE expires < '{dt}'".format(s=s, l=log_table, dt=dt)
+               for s in schemas]
+    try:
+        cur.execute(' UNION ALL '.join(selects))
+        to_clean = cur.fetchall()
+    except Exception:
+        conn.rollback()
+        # one unreadable log table (changed columns, missing permissions) fails the union, read them one by one
+        to_clean = list()
+        for schema, select in zip(schemas, selects):
+            try:
+                cur.execute(select)
+                to_clean += cur.fetchall()
+            except Exception as e:
+                conn.rollback()
+                print ('Clean up failed for {s}.{l}\n\t{e}'.format(s=schema, l=log_table, e=e))
+    if db_type == 'PG':
+        drops = ['DROP TABLE IF EXISTS {}.{}'.format(sch, table) for sch, table in to_clean]
+    else:
+        drops = ["IF OBJECT_ID('{s}.{t}', 'U') IS NOT NULL DROP TABLE {s}.{t}".format(s=sch, t=table)
+                 for sch, table in to_clean]
     cleaned = 0
-    for sch, table in to_clean:
-        dbo.query('DROP TABLE {}.{}'.format(sch, table), strict=False, timeme=False, no_comment=True)
-        clean_out_log(dbo, sch, table, owner)
-        cleaned += 1
+    if drops:
+        try:
+            cur.execute(';\n'.join(drops))
+            conn.commit()
+            cleaned = len(drops)
+        except Exception:
+            conn.rollback()
+            for drop in drops:
+                try:
+                    cur.execute(drop)
+                    conn.commit()
+                    cleaned += 1
+                except Exception:
+                    conn.rollback()
+                    print ('Clean up failed: {}'.format(drop))
+    # expired entries are cleared from the logs even if the drop failed
+    deletes = ["DELETE FROM {s}.{l} WHERE expires < '{dt}'".format(s=s, l=log_table, dt=dt) for s in schemas]
+    try:
+        cur.execute(';\n'.join(deletes))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        for delete in deletes:
+            try:
+                cur.execute(delete)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                print ('Clean up failed: {}'.format(delete))
     if cleaned > 0:
-        'Removed {} temp tables'.format(cleaned)
+        print ('Removed {} temp tables'.format(cleaned))
+    return cleaned
 
 
 def clean_out_log(dbo, schema, table, owner):
@@ -1471,6 +3534,384 @@ def clean_out_log(dbo, schema, table, owner):
     ), strict=False, timeme=False, no_comment=True)
 
 
+def csv_sample(input_file, **kwargs):
+    """
+    Reads a sample of a csv file for type inference without loading the whole file. The sample is the first 
+    rows of the file plus a reservoir sample from the rest of it, read chunk by chunk. Pandas then infers the 
+    dtypes of the sample the same way it would for the whole file.
+    :param input_file: File path to csv file
+    :param kwargs:
+        sep (str): Separator for csv file, defaults to comma (,)
+        head (int): Number of rows from the top of the file always included (defaults to 1,000)
+        sample_size (int): Number of rows sampled from the rest of the file (defaults to 10,000)
+        chunk_size (int): Number of rows read at a time (defaults to 100,000)
+    :return: (Pandas DataFrame of the sampled rows, number of rows in the file)
+    """
+    sep = kwargs.get('sep', ',')
+    head = kwargs.get('head', 1000)
+    sample_size = kwargs.get('sample_size', 10000)
+    chunk_size = kwargs.get('chunk_size', 100000)
+    columns, head_rows, reservoir = None, list(), None
+    filled, seen = 0, 0
+    for chunk in pd.read_csv(input_file, sep=sep, dtype=str, chunksize=chunk_size):
+        if columns is None:
+            columns = chunk.columns
+            reservoir = np.empty((sample_size, len(columns)), dtype=object)
+        values = chunk.values
+        if len(head_rows) < head:
+            take = head - len(head_rows)
+            head_rows += list(values[:take])
+            values = values[take:]
+        # fill the reservoir, then replace random slots with decreasing probability (algorithm R)
+        take = min(sample_size - filled, len(values))
+        reservoir[filled:filled + take] = values[:take]
+        filled += take
+        seen += take
+        values = values[take:]
+        if len(values):
+            slots = (np.random.random(len(values)) * (seen + 1 + np.arange(len(values)))).astype(np.int64)
+            keep = slots < sample_size
+            reservoir[slots[keep]] = values[keep]
+            seen += len(values)
+    if columns is None:
+        return pd.read_csv(input_file, sep=sep), 0
+    rows = np.array(head_rows + list(reservoir[:filled]), dtype=object).reshape(-1, len(columns))
+    # round trip the text through read_csv so the sample gets the dtypes pandas would infer for the file
+    buf = io.BytesIO()
+    pd.DataFrame(rows, columns=columns).to_csv(buf, index=False, encoding='utf-8')
+    buf.seek(0)
+    return pd.read_csv(buf, encoding='utf-8'), len(head_rows) + seen
+
+
+# PG type oids and pyodbc python types that map to fixed pandas dtypes, everything else is object.
+# numeric/decimal stay object (Decimal) like in dfquery, floats would lose precision
+PG_FLOAT_TYPES = (700, 701)
+PG_DATETIME_TYPES = (1114,)
+MS_FLOAT_TYPES = (float,)
+MS_DATETIME_TYPES = (datetime.datetime,)
+# integer types, nullable Int64 in DataFrames and int64 in ColumnarResult
+PG_INT_TYPES = (20, 21, 23, 26)
+MS_INT_TYPES = (int, long)
+
+
+def description_dtypes(description, db_type):
+    """
+    Maps a cursor description to pandas dtypes, so results fetched in batches get a consistent schema
+    :param description: cursor.description
+    :param db_type: Database type (PG/MS)
+    :return: list of dtype names (Int64, float64, datetime64[ns] or object)
+    """
+    if db_type == 'PG':
+        ints, floats, datetimes = PG_INT_TYPES, PG_FLOAT_TYPES, PG_DATETIME_TYPES
+    else:
+        ints, floats, datetimes = MS_INT_TYPES, MS_FLOAT_TYPES, MS_DATETIME_TYPES
+    dtypes = list()
+    for desc in description:
+        if desc[1] in ints:
+            dtypes.append('Int64')
+        elif desc[1] in floats:
+            dtypes.append('float64')
+        elif desc[1] in datetimes:
+            dtypes.append('datetime64[ns]')
+        else:
+            dtypes.append('object')
+    return dtypes
+
+
+def dataframe_to_copy_text(df):
+    """
+    Formats a DataFrame as PostgreSQL COPY text format, one column at a time. Nulls are written as \\N and 
+    backslashes, tabs and line breaks in the values are escaped, so text such as \\N or an empty string is 
+    loaded as is.
+    :param df: Pandas DataFrame
+    :return: utf-8 encoded string with a line per row
+    """
+    if not df.shape[0]:
+        return ''
+    columns = list()
+    for i in range(df.shape[1]):
+        s = df.iloc[:, i]
+        nulls = pd.isnull(s.values)
+        if s.dtype.kind in 'biufM':
+            text = s.astype(str)
+        else:
+            text = s.map(lambda v: v.encode('utf-8') if isinstance(v, unicode) else str(v)).astype(object)
+            text = text.str.replace('\\', '\\\\', regex=False).str.replace('\t', '\\t', regex=False) \
+                .str.replace('\n', '\\n', regex=False).str.replace('\r', '\\r', regex=False)
+        text = text.values.astype(object)
+        text[nulls] = '\\N'
+        columns.append(pd.Series(text))
+    lines = columns[0].str.cat(columns[1:], sep='\t') if len(columns) > 1 else columns[0]
+    return '\n'.join(lines.tolist()) + '\n'
+
+
+def rows_to_dataframe(rows, columns, dtypes):
+    """
+    Builds a DataFrame column by column from row tuples, casting each column to its dtype
+    :param rows: list of row tuples
+    :param columns: column names
+    :param dtypes: dtype names from description_dtypes()
+    :return: Pandas DataFrame
+    """
+    if rows:
+        values = zip(*rows)
+    else:
+        values = [()] * len(columns)
+    data = dict()
+    for i, (col, dtype) in enumerate(zip(values, dtypes)):
+        if dtype == 'Int64':
+            # nullable integers, so NULLs do not turn the column into floats
+            data[i] = pd.Series(list(col), dtype='Int64')
+        elif dtype == 'float64':
+            # numpy casts None to NaN
+            data[i] = np.array(col, dtype='float64')
+        elif dtype == 'datetime64[ns]':
+            data[i] = pd.to_datetime(list(col))
+        else:
+            data[i] = pd.Series(list(col), dtype=object)
+    df = pd.DataFrame(data, columns=range(len(columns)))
+    df.columns = columns
+    return df
+
+
+class ColumnarResult:
+    """
+    Column oriented query result. Rows are fetched from the cursor in batches and each column is kept as a typed 
+    NumPy array with a null mask instead of a list of row tuples. Rows can still be read by index or iterated 
+    over as tuples, and to_pandas() builds a DataFrame straight from the arrays.
+    """
+
+    def __init__(self, description, db_type):
+        """
+
+        :param description: cursor.description
+        :param db_type: Database type (PG/MS)
+        """
+        self.columns = [desc[0] for desc in description]
+        # integers are kept as plain int64 arrays, the null mask covers NULLs
+        self.dtypes = ['int64' if dtype == 'Int64' else dtype for dtype in description_dtypes(description, db_type)]
+        self.arrays = [np.array([], dtype=dtype) for dtype in self.dtypes]
+        self.masks = [np.array([], dtype=bool) for _ in self.dtypes]
+        self.batches = list()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.row(i)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.row(j) for j in range(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('row index out of range')
+        return self.row(i)
+
+    @classmethod
+    def from_cursor(cls, cur, db_type, batch_size=10000):
+        """
+        Fetches all rows of an executed cursor in batches of batch_size
+        :param cur: Cursor with results
+        :param db_type: Database type (PG/MS)
+        :param batch_size: Number of rows fetched at a time (defaults to 10000)
+        :return: ColumnarResult
+        """
+        result = cls(cur.description, db_type)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            result.append(rows)
+        result.finish()
+        return result
+
+    def append(self, rows):
+        """
+        Converts a batch of row tuples to column arrays. Call finish() once all batches are appended.
+        :param rows: list of row tuples
+        :return: 
+        """
+        if not rows:
+            return
+        batch = list()
+        for col, dtype in zip(zip(*rows), self.dtypes):
+            values = np.empty(len(col), dtype=object)
+            values[:] = col
+            mask = np.array([v is None for v in col], dtype=bool)
+            if dtype == 'datetime64[ns]':
+                values = pd.to_datetime(values).values
+            elif dtype != 'object':
+                values[mask] = 0
+                values = values.astype(dtype)
+            batch.append((values, mask))
+        self.batches.append(batch)
+        self.length += len(rows)
+
+    def finish(self):
+        """
+        Joins the appended batches into one array per column
+        :return: 
+        """
+        if not self.batches:
+            return
+        for i in range(len(self.columns)):
+            self.arrays[i] = np.concatenate([self.arrays[i]] + [batch[i][0] for batch in self.batches])
+            self.masks[i] = np.concatenate([self.masks[i]] + [batch[i][1] for batch in self.batches])
+        self.batches = list()
+
+    def row(self, i):
+        """
+        :param i: Row number
+        :return: Row as a tuple of python values
+        """
+        row = list()
+        for values, mask, dtype in zip(self.arrays, self.masks, self.dtypes):
+            if mask[i]:
+                row.append(None)
+            elif dtype == 'datetime64[ns]':
+                row.append(pd.Timestamp(values[i]).to_pydatetime())
+            elif dtype == 'object':
+                row.append(values[i])
+            else:
+                row.append(values[i].item())
+        return tuple(row)
+
+    @property
+    def nbytes(self):
+        """
+        Approximate memory used by the result, object columns are extrapolated from their first values
+        :return: Size in bytes
+        """
+        size = 0
+        for values, mask in zip(self.arrays, self.masks):
+            size += values.nbytes + mask.nbytes
+            if values.dtype == object and len(values):
+                sample = values[:100]
+                size += sum([sys.getsizeof(v) for v in sample]) * len(values) // len(sample)
+        return size
+
+    def to_pandas(self):
+        """
+        Builds a DataFrame from the column arrays. Nulls are NaN/NaT in numeric and date columns (integer columns 
+        with nulls become float64) and None in object columns.
+        :return: Pandas DataFrame
+        """
+        data = dict()
+        for i, (values, mask) in enumerate(zip(self.arrays, self.masks)):
+            if self.dtypes[i] == 'int64' and mask.any():
+                values = values.astype('float64')
+                values[mask] = np.nan
+            elif self.dtypes[i] == 'float64' and mask.any():
+                values[mask] = np.nan
+            data[i] = values
+        df = pd.DataFrame(data, columns=range(len(self.columns)), copy=False)
+        df.columns = self.columns
+        return df
+
+
+class CopyPipe:
+    """
+    Bounded in-memory pipe from a writer thread (eg. COPY TO STDOUT) to a reader thread (COPY FROM STDIN). 
+    Writes are gathered into chunk_size blocks and at most max_chunks blocks are held, so the faster side waits 
+    for the slower one rather than the whole table being buffered. Each write counts as one row for the progress bar 
+    unless rows is given.
+    """
+
+    def __init__(self, chunk_size=1024 ** 2, max_chunks=16, total=None):
+        """
+
+        :param chunk_size: Bytes per block passed between the threads (defaults to 1MB)
+        :param max_chunks: Number of blocks buffered before the writer waits (defaults to 16)
+        :param total: Expected number of rows, for the progress bar
+        """
+        self.chunk_size = chunk_size
+        self.queue = Queue.Queue(max_chunks)
+        self.buffer = list()
+        self.buffered = 0
+        self.rows = 0
+        self.reported = 0
+        self.chunk = ''
+        self.offset = 0
+        self.eof = False
+        self.aborted = False
+        self.error = None
+        self.progress = tqdm(total=total or None, unit='rows')
+
+    def put(self, item):
+        # gives up once the reader has aborted, so the writer thread is not blocked forever
+        while not self.aborted:
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        raise IOError('COPY pipe aborted by the reader')
+
+    def write(self, data, rows=1):
+        """
+        :param data: Bytes to send
+        :param rows: Number of rows in data
+        :return: None
+        """
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.rows += rows
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.put(''.join(self.buffer))
+            self.buffer = list()
+            self.buffered = 0
+            self.progress.update(self.rows - self.reported)
+            self.reported = self.rows
+
+    def close(self, error=None):
+        """
+        Ends the data, the reader gets an IOError instead of the end of the data if error is given
+        :param error: Exception raised on the writing side
+        :return: None
+        """
+        self.error = error
+        try:
+            if error is None:
+                self.flush()
+            self.put(None)
+        except IOError:
+            pass
+
+    def abort(self):
+        """
+        Stops the writer, called when the reading side fails
+        :return: None
+        """
+        self.aborted = True
+
+    def read(self, size=-1):
+        """
+        :param size: Maximum number of bytes returned
+        :return: Next bytes written, an empty string once the writer has closed the pipe
+        """
+        if self.offset >= len(self.chunk):
+            if self.eof:
+                return ''
+            self.chunk, self.offset = self.queue.get(), 0
+            if self.chunk is None:
+                self.chunk, self.eof = '', True
+                if self.error is not None:
+                    raise IOError('COPY source failed: {}'.format(self.error))
+                return ''
+        end = len(self.chunk) if size is None or size < 0 else self.offset + size
+        data = self.chunk[self.offset:end]
+        self.offset += len(data)
+        return data
+
+
 def print_cmd_string(password_list, cmd_string):
     for p in password_list:
         cmd_string = cmd_string.replace(p, '*'*len(p))
@@ -1546,7 +3987,316 @@ def pg_to_sql(pg, ms, org_table, **kwargs):
     subprocess.call(cmd.replace('\n', ' '), shell=True)
 
 
+# SQL Server to PostgreSQL column types used by sql_to_pg, types not listed are copied as text
+MS_TO_PG_TYPES = {
+    'bit': 'boolean', 'tinyint': 'smallint', 'smallint': 'smallint', 'int': 'integer', 'bigint': 'bigint',
+    'real': 'real', 'float': 'double precision', 'money': 'numeric(19, 4)', 'smallmoney': 'numeric(10, 4)',
+    'date': 'date', 'time': 'time', 'datetime': 'timestamp', 'datetime2': 'timestamp',
+    'smalldatetime': 'timestamp', 'datetimeoffset': 'timestamptz', 'uniqueidentifier': 'uuid',
+    'text': 'text', 'ntext': 'text', 'xml': 'text', 'binary': 'bytea', 'varbinary': 'bytea', 'image': 'bytea',
+    'timestamp': 'bytea', 'rowversion': 'bytea', 'geometry': 'geometry', 'geography': 'geography'
+}
+# tokens that decide if a SQL Server query can be used as a derived table, comments and quoted text are skipped
+MS_DERIVED_SCAN = re.compile(r"""
+    (?P<skip>--[^\n]*|/\*.*?\*/|'(?:[^']|'')*'|"(?:[^"]|"")*"|\[[^\]]*\])
+    |(?P<open>\()
+    |(?P<close>\))
+    |\b(?P<kw>order\s+by|top|offset|for\s+xml)\b
+""", re.I | re.S | re.X)
+
+
+def ms_columns(cur, table=None, schema='dbo', query=None):
+    """
+    Gets the columns of a SQL Server table (from INFORMATION_SCHEMA.COLUMNS) or of the results of a query 
+    (from sp_describe_first_result_set)
+    :param cur: pyodbc cursor
+    :param table: Table name
+    :param schema: Schema of the table (defaults to dbo)
+    :param query: SQL select statement, used instead of table
+    :return: list of (name, type, length, precision, scale), length is in characters and -1 for max
+    """
+    if query is None:
+        cur.execute("""
+            SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, NUMERIC_PRECISION, NUMERIC_SCALE
+            FROM INFORMATION_SCHEMA.COLUMNS
+            WHERE TABLE_SCHEMA = ? AND TABLE_NAME = ?
+            ORDER BY ORDINAL_POSITION
+        """, schema, table)
+        return [(row[0], row[1].lower(), row[2], row[3], row[4]) for row in cur.fetchall()]
+    cur.execute('EXEC sp_describe_first_result_set @tsql = ?', query)
+    names = [desc[0] for desc in cur.description]
+    columns = list()
+    for row in cur.fetchall():
+        row = dict(zip(names, row))
+        if row.get('is_hidden'):
+            continue
+        typ = row['system_type_name'].split('(')[0].strip().lower()
+        length = row['max_length']
+        if typ in ('nchar', 'nvarchar') and length > 0:
+            length //= 2
+        columns.append((row['name'], typ, length, row['precision'], row['scale']))
+    return columns
+
+
+def ms_to_pg_type(typ, length=None, precision=None, scale=None):
+    """
+    :param typ: SQL Server type name
+    :param length: Character length (-1 for max)
+    :param precision: Numeric precision
+    :param scale: Numeric scale
+    :return: PostgreSQL type
+    """
+    if typ in ('char', 'nchar', 'varchar', 'nvarchar'):
+        if not length or length < 0:
+            return 'text'
+        return '{t} ({n})'.format(t='char' if typ in ('char', 'nchar') else 'varchar', n=length)
+    if typ in ('decimal', 'numeric'):
+        return 'numeric ({p}, {s})'.format(p=precision, s=scale)
+    return MS_TO_PG_TYPES.get(typ, 'text')
+
+
+def ms_select_expression(name, typ, srid=2263):
+    """
+    SQL Server expression a column is selected with for sql_to_pg: geometries become 'SRID=n;' + hex WKB 
+    (which PostGIS reads directly, columns without an SRID get srid), geographies 'SRID=n;' + WKT, 
+    datetimeoffset becomes ISO 8601 text and types pyodbc can not read become text
+    :param name: Column name
+    :param typ: SQL Server type name
+    :param srid: SRID for geometries without one (defaults to 2263)
+    :return: SQL expression
+    """
+    col = '[{}]'.format(name.replace(']', ']]'))
+    if typ == 'geometry':
+        return "'SRID=' + CAST(COALESCE(NULLIF({c}.STSrid, 0), {srid}) AS varchar(12)) + ';' + " \
+               "CONVERT(varchar(max), {c}.STAsBinary(), 2) AS {c}".format(c=col, srid=srid)
+    if typ == 'geography':
+        # PostGIS geography input does not take 'SRID=n;' + hex WKB, only WKT (or plain hex WKB)
+        return "'SRID=' + CAST(COALESCE(NULLIF({c}.STSrid, 0), 4326) AS varchar(12)) + ';' + " \
+               "{c}.STAsText() AS {c}".format(c=col)
+    if typ == 'datetimeoffset':
+        return 'CONVERT(varchar(40), {c}, 127) AS {c}'.format(c=col)
+    if typ in ('hierarchyid', 'sql_variant'):
+        return 'CAST({c} AS nvarchar(max)) AS {c}'.format(c=col)
+    return col
+
+
+def ms_derived_table(query):
+    """
+    Checks a SQL Server query can be wrapped as SELECT ... FROM (query) q. Queries starting with WITH can not be 
+    nested, and ORDER BY is only allowed in a derived table with TOP, OFFSET or FOR XML.
+    :param query: SQL Server select statement
+    :return: True if the query can be wrapped
+    """
+    first = SQL_FIRST_WORD.match(query)
+    if first and first.group(1).lower() == 'with':
+        return False
+    depth = 0
+    top_level = set()
+    for m in MS_DERIVED_SCAN.finditer(query):
+        if m.group('skip'):
+            continue
+        if m.group('open'):
+            depth += 1
+        elif m.group('close'):
+            depth = max(depth - 1, 0)
+        elif depth == 0:
+            top_level.add(re.sub(r'\s+', ' ', m.group('kw').lower()))
+    return 'order by' not in top_level or bool(top_level & set(['top', 'offset', 'for xml']))
+
+
+def ms_copy_value(value):
+    """
+    Formats a pyodbc value for COPY text format: unicode is encoded as utf-8, byte strings that are not utf-8 are 
+    read as cp1252 (the default SQL Server code page) and backslashes, tabs and line breaks are escaped, so text 
+    such as \\N is not read as NULL
+    :param value: Value from pyodbc (not None)
+    :return: String
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, str):
+        try:
+            value.decode('utf-8')
+        except UnicodeDecodeError:
+            value = value.decode('cp1252', 'replace').encode('utf-8')
+    elif isinstance(value, float):
+        return repr(value)
+    elif isinstance(value, (bytearray, buffer)):
+        return ms_copy_bytea(value)
+    else:
+        return str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def ms_copy_bytea(value):
+    """
+    :param value: Binary value from pyodbc (str, bytearray or buffer)
+    :return: PostgreSQL bytea hex text, escaped for COPY text format
+    """
+    return '\\\\x' + binascii.hexlify(str(value))
+
+
+def sql_to_pg_copy(ms, pg, select, columns, table_name, dest_schema, **kwargs):
+    """
+    Streams the results of a SQL Server select into a new PostgreSQL table. A reader thread fetches batches with 
+    pyodbc fetchmany and writes them as COPY text into a CopyPipe, while the calling thread runs COPY FROM STDIN on 
+    PostgreSQL, so reading from SQL Server and writing to PostgreSQL overlap.
+    :param ms: DbConnect instance connecting to SQL Server
+    :param pg: DbConnect instance connecting to PostgreSQL
+    :param select: SQL Server select returning the columns in order
+    :param columns: list of (name, type, length, precision, scale) from ms_columns()
+    :param table_name: Destination table name, an existing table is replaced
+    :param dest_schema: Destination schema
+    :param kwargs: 
+        :batch_size (int): Rows per fetchmany batch (defaults to 10,000)
+        :temp (bool): Log the new table for deletion like other temp tables (defaults to False)
+        :total (int): Expected number of rows, for the progress bar
+    :return: Number of rows copied (None if the copy failed)
+    """
+    batch_size = kwargs.get('batch_size', 10000)
+    col_names = ', '.join(['"{}"'.format(pg.clean_column(c[0])) for c in columns])
+    pg.query('DROP TABLE IF EXISTS {s}."{t}"'.format(s=dest_schema, t=table_name), timeme=False)
+    pg.query('CREATE TABLE {s}."{t}" ({cols})'.format(
+        s=dest_schema, t=table_name,
+        cols=', '.join(['"{c}" {typ}'.format(c=pg.clean_column(c[0]), typ=ms_to_pg_type(*c[1:])) for c in columns])),
+        timeme=False, temp=kwargs.get('temp', False))
+    binary_types = ('binary', 'varbinary', 'image', 'timestamp', 'rowversion')
+    converters = [ms_copy_bytea if c[1] in binary_types else ms_copy_value for c in columns]
+
+    src = ms.borrow_connection()
+    dst = pg.borrow_connection()
+    pipe = CopyPipe(total=kwargs.get('total', None))
+    failed = False
+    rows = None
+
+    def read_source():
+        try:
+            cur = src.cursor()
+            cur.execute(select)
+            while True:
+                batch = cur.fetchmany(batch_size)
+                if not batch:
+                    break
+                pipe.write(''.join(['\t'.join(['\\N' if v is None else conv(v) for conv, v in zip(converters, row)])
+                                    + '\n' for row in batch]), len(batch))
+            pipe.close()
+        except Exception as e:
+            pipe.close(e)
+
+    print 'Copying to {s}.{t}'.format(s=dest_schema, t=table_name)
+    start = time.time()
+    reader = threading.Thread(target=read_source)
+    reader.start()
+    try:
+        cur = dst.cursor()
+        cur.copy_expert("""COPY {s}."{t}" ({cols}) FROM STDIN WITH (FORMAT text)""".format(
+            s=dest_schema, t=table_name, cols=col_names), pipe, size=pipe.chunk_size)
+        dst.commit()
+        rows = cur.rowcount if cur.rowcount >= 0 else pipe.rows
+    except Exception as e:
+        failed = True
+        pipe.abort()
+        dst.rollback()
+        print ('Failure:\nCopy to {s}.{t} failed\n\t{e}'.format(s=dest_schema, t=table_name, e=pipe.error or e))
+    finally:
+        reader.join()
+        pipe.progress.close()
+        ms.release_connection(src, discard=failed)
+        pg.release_connection(dst, discard=failed)
+    pg.invalidate_cache([table_name])
+    if failed:
+        return None
+    elapsed = time.time() - start
+    print '{r} rows copied in {t:.1f} seconds ({s:.0f} rows/second)'.format(
+        r=rows, t=elapsed, s=rows / elapsed if elapsed else 0)
+    clean_geom_column(pg, table_name, dest_schema)
+    return rows
+
+
 def sql_to_pg_qry(ms, pg, query, **kwargs):
+    """
+    Copies the results of a SQL Server query to a new PostgreSQL table (see sql_to_pg_copy). Column types come from 
+    sp_describe_first_result_set, geometry and geography columns are copied as PostGIS types.
+    :param ms: DbConnect instance connecting to SQL Server
+    :param pg: DbConnect instance connecting to PostgreSQL
+    :param query: SQL Server select statement
+    :param kwargs: 
+        :dest_schema: PostgreSQL schema for destination table (defaults to public)
+        :table_name: Destination table name (defaults to _user_YYYYMMDDHHMM)
+        :srid (int): SRID for geometries without one (defaults to 2263)
+        :batch_size (int): Rows per fetchmany batch (defaults to 10,000)
+        :temp (bool): Log the new table for deletion like other temp tables (defaults to False)
+        :ogr (bool): Copy with ogr2ogr instead (defaults to False)
+    :return: Number of rows copied (None if the copy failed)
+    """
+    if kwargs.get('ogr', False):
+        return sql_to_pg_qry_ogr(ms, pg, query, **kwargs)
+    dest_schema = kwargs.get('dest_schema', 'public')
+    table_name = kwargs.get('table_name', '_{u}_{d}'.format(
+        u=pg.user, d=datetime.datetime.now().strftime('%Y%m%d%H%M')))
+    srid = kwargs.get('srid', 2263)
+    conn = ms.borrow_connection()
+    try:
+        columns = ms_columns(conn.cursor(), query=query)
+    except Exception as e:
+        ms.release_connection(conn, discard=True)
+        print ('Failure:\nCould not describe the query\n\t{e}'.format(e=e))
+        return None
+    ms.release_connection(conn)
+    exprs = [ms_select_expression(c[0], c[1], srid) for c in columns]
+    # the query only needs wrapping when a column has to be converted
+    if exprs != ['[{}]'.format(c[0].replace(']', ']]')) for c in columns]:
+        if not ms_derived_table(query):
+            print 'The query (WITH or ORDER BY) can not be wrapped to convert its columns, copying with ogr2ogr'
+            return sql_to_pg_qry_ogr(ms, pg, query, **kwargs)
+        query = 'SELECT {e} FROM ({q}) q'.format(e=', '.join(exprs), q=query.strip().rstrip(';'))
+    return sql_to_pg_copy(ms, pg, query, columns, table_name.lower(), dest_schema, **kwargs)
+
+
+def sql_to_pg(ms, pg, org_table, **kwargs):
+    """
+    Migrates tables from SQL Server to PostgreSQL (see sql_to_pg_copy), generates spatial tables in PG if spatial 
+    in MS. Column types come from INFORMATION_SCHEMA.COLUMNS.
+    :param ms: DbConnect instance connecting to SQL Server source database
+    :param pg: DbConnect instance connecting to PostgreSQL destination database
+    :param org_table: table name of table to migrate
+    :param kwargs: 
+        :org_schema: SQL Server schema for origin table (defaults to dbo) 
+        :dest_schema: PostgreSQL schema for destination table (defaults to public)
+        :srid (int): SRID for geometries without one (defaults to 2263)
+        :batch_size (int): Rows per fetchmany batch (defaults to 10,000)
+        :temp (bool): Log the new table for deletion like other temp tables (defaults to False)
+        :ogr (bool): Copy with ogr2ogr instead (defaults to False)
+    :return: Number of rows copied (None if the copy failed)
+    """
+    if kwargs.get('ogr', False):
+        return sql_to_pg_ogr(ms, pg, org_table, **kwargs)
+    org_schema = kwargs.get('org_schema', 'dbo')
+    dest_schema = kwargs.get('dest_schema', 'public')
+    srid = kwargs.get('srid', 2263)
+    conn = ms.borrow_connection()
+    try:
+        cur = conn.cursor()
+        columns = ms_columns(cur, org_table, org_schema)
+        cur.execute("""
+            SELECT SUM(rows) FROM sys.partitions 
+            WHERE object_id = OBJECT_ID(?) AND index_id IN (0, 1)
+        """, '{s}.{t}'.format(s=org_schema, t=org_table))
+        total = cur.fetchone()[0]
+    finally:
+        ms.release_connection(conn)
+    if not columns:
+        print 'Failure:\n{s}.{t} not found'.format(s=org_schema, t=org_table)
+        return None
+    query = 'SELECT {e} FROM [{s}].[{t}]'.format(e=', '.join([ms_select_expression(c[0], c[1], srid) for c in columns]),
+                                                  s=org_schema, t=org_table)
+    return sql_to_pg_copy(ms, pg, query, columns, org_table.lower(), dest_schema, **dict(kwargs, total=total))
+
+
+def sql_to_pg_qry_ogr(ms, pg, query, **kwargs):
+    """
+    Copies the results of a SQL Server query to PostgreSQL with ogr2ogr (see sql_to_pg_qry)
+    """
     LDAP = kwargs.get('ldap', False)
     spatial = kwargs.get('spatial', True)
     dest_schema = kwargs.get('dest_schema', 'public')
@@ -1608,9 +4358,9 @@ def sql_to_pg_qry(ms, pg, query, **kwargs):
     clean_geom_column(pg, table_name, dest_schema)
 
 
-def sql_to_pg(ms, pg, org_table, **kwargs):
+def sql_to_pg_ogr(ms, pg, org_table, **kwargs):
     """    
-    Migrates tables from SQL Server to PostgreSQL, generates spatial tables in PG if spatial in MS.
+    Migrates tables from SQL Server to PostgreSQL with ogr2ogr, generates spatial tables in PG if spatial in MS.
     :param ms: DbConnect instance connecting to SQL Server destination database
     :param pg: DbConnect instance connecting to PostgreSQL source database
     :param org_table: table name of table to migrate
@@ -1683,6 +4433,123 @@ def sql_to_pg(ms, pg, org_table, **kwargs):
 
 
 def pg_to_pg(from_pg, to_pg, org_table, **kwargs):
+    """
+    Copies a table between PostgreSQL databases. The destination table is created from the source catalog 
+    (column names and format_type() types) and the rows are streamed from COPY TO STDOUT on the source straight 
+    into COPY FROM STDIN on the destination through a bounded in-memory pipe (see CopyPipe), so nothing is written 
+    to disk or re-encoded. Binary format needs the column types (eg. PostGIS geometry) to exist on the destination.
+    :param from_pg: DbConnect instance connecting to the PostgreSQL source database
+    :param to_pg: DbConnect instance connecting to the PostgreSQL destination database
+    :param org_table: table name of table to copy
+    :param kwargs: 
+        :org_schema: Schema of the source table (defaults to public)
+        :dest_schema: Schema for the destination table (defaults to public)
+        :dest_name: Name of the destination table (defaults to org_table), an existing table is replaced
+        :binary (bool): Use COPY binary format, otherwise text (defaults to True)
+        :temp (bool): Log the new table for deletion like other temp tables (defaults to False)
+        :ogr (bool): Copy with ogr2ogr instead (defaults to False)
+        :print_cmd: Option to print the ogr2ogr command line statement (defaults to False) - used for debugging
+    :return: Number of rows copied (None if the copy failed, or if psycopg2 does not report the count of a 
+        binary COPY)
+    """
+    org_schema = kwargs.get('org_schema', 'public')
+    dest_schema = kwargs.get('dest_schema', 'public')
+    dest_name = kwargs.get('dest_name', org_table)
+    if kwargs.get('ogr', False):
+        return pg_to_pg_ogr(from_pg, to_pg, org_table, **kwargs)
+    copy_format = 'binary' if kwargs.get('binary', True) else 'text'
+
+    src = from_pg.borrow_connection()
+    cur = src.cursor()
+    cur.execute("""
+        SELECT a.attname, format_type(a.atttypid, a.atttypmod)
+        FROM pg_attribute a
+        JOIN pg_class c ON a.attrelid = c.oid
+        JOIN pg_namespace n ON c.relnamespace = n.oid
+        WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum
+    """, (org_schema, org_table))
+    columns = cur.fetchall()
+    cur.execute("""
+        SELECT c.reltuples::bigint
+        FROM pg_class c
+        JOIN pg_namespace n ON c.relnamespace = n.oid
+        WHERE n.nspname = %s AND c.relname = %s
+    """, (org_schema, org_table))
+    estimate = ([i[0] for i in cur.fetchall()] or [0])[0]
+    src.rollback()
+    if not columns:
+        from_pg.release_connection(src)
+        print 'Failure:\n{s}.{t} not found'.format(s=org_schema, t=org_table)
+        return None
+
+    col_names = ', '.join(['"{}"'.format(c[0].replace('"', '""')) for c in columns])
+    to_pg.query('DROP TABLE IF EXISTS {s}."{t}"'.format(s=dest_schema, t=dest_name), timeme=False)
+    to_pg.query('CREATE TABLE {s}."{t}" ({cols})'.format(
+        s=dest_schema, t=dest_name,
+        cols=', '.join(['"{c}" {typ}'.format(c=c[0].replace('"', '""'), typ=c[1]) for c in columns])),
+        timeme=False, temp=kwargs.get('temp', False))
+
+    dst = to_pg.borrow_connection()
+    pipe = CopyPipe(total=max(estimate, 0))
+    failed = False
+    rows = None
+    source_rows = list()
+
+    def read_source():
+        try:
+            src_cur = src.cursor()
+            src_cur.copy_expert('COPY {s}."{t}" ({cols}) TO STDOUT (FORMAT {f})'.format(
+                s=org_schema, t=org_table, cols=col_names, f=copy_format), pipe)
+            source_rows.append(src_cur.rowcount)
+            pipe.close()
+        except Exception as e:
+            pipe.close(e)
+
+    print 'Copying {fs}.{ft} to {ts}.{tt}'.format(fs=org_schema, ft=org_table, ts=dest_schema, tt=dest_name)
+    start = time.time()
+    reader = threading.Thread(target=read_source)
+    reader.start()
+    try:
+        cur = dst.cursor()
+        cur.copy_expert('COPY {s}."{t}" ({cols}) FROM STDIN (FORMAT {f})'.format(
+            s=dest_schema, t=dest_name, cols=col_names, f=copy_format), pipe, size=pipe.chunk_size)
+        dst.commit()
+        reader.join()
+        # older psycopg2 versions do not report the COPY row count. Each text COPY write is one row, binary writes
+        # are not rows (the header and trailer are written too), so the count is left unknown
+        rows = cur.rowcount
+        if rows < 0:
+            rows = source_rows[0] if source_rows and source_rows[0] >= 0 else None
+        if rows is None and copy_format == 'text':
+            rows = pipe.rows
+    except Exception as e:
+        failed = True
+        pipe.abort()
+        dst.rollback()
+        print ('Failure:\nCopy of {s}.{t} failed\n\t{e}'.format(s=org_schema, t=org_table, e=pipe.error or e))
+    finally:
+        reader.join()
+        pipe.progress.close()
+        from_pg.release_connection(src, discard=failed)
+        to_pg.release_connection(dst, discard=failed)
+    to_pg.invalidate_cache([dest_name])
+    if failed:
+        return None
+    elapsed = time.time() - start
+    if rows is None:
+        print 'Copied in {t:.1f} seconds (row count not reported)'.format(t=elapsed)
+    else:
+        print '{r} rows copied in {t:.1f} seconds ({s:.0f} rows/second)'.format(
+            r=rows, t=elapsed, s=rows / elapsed if elapsed else 0)
+    clean_geom_column(to_pg, dest_name, dest_schema)
+    return rows
+
+
+def pg_to_pg_ogr(from_pg, to_pg, org_table, **kwargs):
+    """
+    Copies a table between PostgreSQL databases with ogr2ogr (see pg_to_pg)
+    """
     org_schema = kwargs.get('org_schema', 'public')
     dest_schema = kwargs.get('dest_schema', 'public')
     print_cmd = kwargs.get('print_cmd', False)